@@ -1,4 +1,23 @@
 from google.appengine.ext import vendor
 
+from utilities import ImportTimer
+
+# runs before any app module, so it sees the whole startup.
+# see report_startup and /test/startup
+import_timer = ImportTimer()
+import_timer.install()
+
+def report_startup(app_name):
+    """
+    Logs the slowest imports once the first app module is loaded,
+    and stops timing, so imports inside handlers don't pay for it.
+    """
+    if not import_timer.installed():
+        return
+    import_timer.uninstall()
+    import logging
+    logging.info("Imports on %s startup:\n%s" % 
+        (app_name, import_timer.report()))
+
 # Add any libraries installed in the "lib" folder.
 vendor.add('lib')
\ No newline at end of file
@@ -0,0 +1,70 @@
+"""
+Google sign in. Imported lazily by main.app's routes,
+so only requests that log in or out pay for the OAuth client.
+"""
+import logging
+import os
+
+from apiclient.discovery import build
+from oauth2client.appengine import OAuth2DecoratorFromClientSecrets
+
+from database import User, UserContext
+from main import BaseHandler
+
+SCOPE = (
+    'https://www.googleapis.com/auth/plus.login '
+    'https://www.googleapis.com/auth/userinfo.email')
+
+decorator = OAuth2DecoratorFromClientSecrets(
+    os.path.join(os.path.dirname(__file__), 'secrets', 'client_secret.json'), 
+    scope=SCOPE,
+    approval_prompt='force')
+
+class LoginHandler(BaseHandler):
+    @decorator.oauth_required
+    def get(self):
+        """
+        Sort of login and register.
+        First time user logs in they will be added to the db.
+        """
+        if not decorator.has_credentials():
+            # direct to oauth
+            url = decorator.authorize_url()
+            self.render('login.html', url=url)
+            return
+
+        # check if still valid
+        credentials = decorator.get_credentials()
+        if credentials.access_token_expired:
+            logging.info("access token expired")
+            credentials.refresh(decorator.http())
+
+        # get user info w/ oauth2
+        service = build('plus', 'v1', http=decorator.http())
+        people_doc = service.people().get(userId='me').execute()
+        uid = str(people_doc.get('id'))
+        name = str(people_doc.get('displayName'))
+        
+        # add new user to database
+        if User.get_by_id(uid) is None:
+            user = User(
+                id=uid, 
+                name=name,
+                credentials=credentials)
+            user.put()
+            UserContext.invalidate(uid)
+
+        # login user w/ cookie
+        self.login(uid, name)
+
+        self.redirect('/')
+
+class LogoutHandler(BaseHandler):
+    @decorator.oauth_required
+    def get(self):
+        self.logout() # clear cookie
+        credentials = decorator.get_credentials()
+        credentials.revoke(decorator.http())
+        self.redirect('/')
+
+OAuth2CallbackHandler = decorator.callback_handler()
@@ -1,11 +1,22 @@
+import bisect
+import calendar
+import collections
+import json
 import logging
 import pickle
+import struct
+import time
+import uuid
+import zlib
 from enum import Enum
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 from oauth2client.appengine import CredentialsNDBProperty
 
-from tmdb import TMDB
-from datetime import datetime, timedelta
+from tmdb import TMDB, SERIES_TTL, INTERACTIVE_WAIT
+from utilities import LRUCache, gzip_compress, gzip_decompress
+from datetime import date, datetime, timedelta
 
 class AppStat(ndb.Model):
     """Table for getting data about server"""
@@ -13,6 +24,141 @@ class AppStat(ndb.Model):
     value = ndb.IntegerProperty()
     text = ndb.StringProperty()
 
+class TrackedSeries(ndb.Model):
+    """
+    Sorted ids of every Series we store, packed as 4 byte ints,
+    so a TMDb change feed can be filtered with one read.
+    One entity, so add can run into contention when many series
+    are loaded at once. reconcile catches up on the adds that failed.
+    """
+    ids = ndb.BlobProperty(required=True)
+
+    STRING_ID = 'singleton'
+    # little-endian, the same on every platform unlike array('i')
+    ID_FORMAT = '<%di'
+
+    @classmethod
+    def pack(cls, ids):
+        return struct.pack(cls.ID_FORMAT % len(ids), *ids)
+
+    def id_array(self):
+        return list(struct.unpack(self.ID_FORMAT % (len(self.ids) // 4), 
+            self.ids))
+
+    @classmethod
+    def reconcile(cls):
+        """
+        Adds any stored series the index misses, from a keys-only query.
+        The query is eventually consistent, so ids are only ever added,
+        never dropped because a fresh put isn't visible yet.
+        """
+        ids = [k.integer_id() for k in Series.query().fetch(keys_only=True)]
+        return cls._merge(ids)
+
+    @classmethod
+    @ndb.transactional
+    def _merge(cls, series_ids):
+        index = cls.get_by_id(cls.STRING_ID)
+        ids = set(index.id_array()) if index else set()
+        if index is None or not ids.issuperset(series_ids):
+            ids.update(series_ids)
+            index = cls(id=cls.STRING_ID, ids=cls.pack(sorted(ids)))
+            index.put()
+        return index
+
+    @classmethod
+    def get_ids(cls):
+        """Returns a sorted list of the ids of stored series"""
+        index = cls.get_by_id(cls.STRING_ID)
+        if index is None:
+            index = cls.reconcile()
+        return index.id_array()
+
+    @classmethod
+    def contains(cls, series_id):
+        index = cls.get_by_id(cls.STRING_ID)
+        if index is None:
+            return False
+        ids = index.id_array()
+        i = bisect.bisect_left(ids, series_id)
+        return i < len(ids) and ids[i] == series_id
+
+    @classmethod
+    def add(cls, series_id):
+        """
+        Adds a series to the index. Failures are only logged,
+        the series is stored and the daily reconcile will add it.
+        """
+        try:
+            cls._add(series_id)
+        except (datastore_errors.TransactionFailedError, 
+            datastore_errors.Timeout) as e:
+            logging.warning("Couldn't index series %d: %s" % (series_id, e))
+
+    @classmethod
+    @ndb.transactional
+    def _add(cls, series_id):
+        index = cls.get_by_id(cls.STRING_ID)
+        if index is None:
+            # get_ids will rebuild it
+            return
+
+        ids = index.id_array()
+        i = bisect.bisect_left(ids, series_id)
+        if i < len(ids) and ids[i] == series_id:
+            return
+        ids.insert(i, series_id)
+        index.ids = cls.pack(ids)
+        index.put()
+
+class SearchIndexSnapshot(ndb.Model):
+    """
+    Series.search_row of every Series we store,
+    built by a task for search.LocalIndex to load in one batch.
+    The rows are json, compressed and split into chunks under the
+    entity size limit. The first chunk has id STRING_ID,
+    the others STRING_ID-1, STRING_ID-2...
+    """
+    # database.search_version when it was built
+    version = ndb.IntegerProperty(required=True, indexed=False)
+    # number of chunks, read from the first one
+    chunks = ndb.IntegerProperty(default=1, indexed=False)
+    # a piece of the compressed rows
+    data = ndb.BlobProperty()
+
+    STRING_ID = 'singleton'
+    CHUNK_SIZE = 900 * 1000 # bytes, entities are limited to 1MB
+
+    @classmethod
+    def chunk_key(cls, i):
+        return ndb.Key(cls, cls.STRING_ID if i == 0 else 
+            '%s-%d' % (cls.STRING_ID, i))
+
+    @classmethod
+    def save(cls, version, rows):
+        data = zlib.compress(json.dumps(rows, separators=(',',':')))
+        pieces = [data[i:i + cls.CHUNK_SIZE] 
+            for i in range(0, len(data), cls.CHUNK_SIZE)]
+        ndb.put_multi([cls(key=cls.chunk_key(i), version=version, 
+            chunks=len(pieces), data=piece) 
+            for i, piece in enumerate(pieces)])
+
+    @classmethod
+    def load(cls):
+        """
+        Returns the version and rows of the snapshot,
+        or None if there's none or it's halfway written.
+        """
+        first = cls.chunk_key(0).get()
+        if first is None or first.data is None:
+            return None
+        chunks = [first] + ndb.get_multi(
+            [cls.chunk_key(i) for i in range(1, first.chunks)])
+        if any(c is None or c.version != first.version for c in chunks):
+            return None
+        data = zlib.decompress(''.join(c.data for c in chunks))
+        return first.version, json.loads(data)
+
 class User(ndb.Model):
     """id is str(google id)"""
     name = ndb.StringProperty(required=True)
@@ -22,47 +168,108 @@ class User(ndb.Model):
     def get_id(self):
         return self.key.string_id()
 
+class UserContext(collections.namedtuple('UserContext', ['id', 'name'])):
+    """
+    What handlers need of a User, without the pickled credentials.
+    Looked up in instance memory, then memcache, then the datastore.
+    """
+    __slots__ = ()
+
+    PREFIX = 'user-context:'
+    LOCAL_TTL = 60 # seconds in instance memory
+    _local = LRUCache(1000) # uid to (expires, UserContext)
+
+    def get_id(self):
+        return self.id
+
+    @classmethod
+    def for_id(cls, uid):
+        """Returns None if there is no such user"""
+        cached = cls._local.get(uid)
+        if cached is not None and cached[0] > time.time():
+            return cached[1]
+
+        fields = memcache.get(cls.PREFIX + uid)
+        if fields is None:
+            user = User.get_by_id(uid)
+            if user is None:
+                return None
+            fields = (user.get_id(), user.name)
+            memcache.set(cls.PREFIX + uid, fields)
+
+        context = cls(*fields)
+        cls._local.set(uid, (time.time() + cls.LOCAL_TTL, context))
+        return context
+
+    @classmethod
+    def invalidate(cls, uid):
+        """Call after changing the User, other instances expire by TTL"""
+        cls._local.delete(uid)
+        memcache.delete(cls.PREFIX + uid)
+
 class Series(ndb.Model):
     """
-    Contains information about a TV series, its seasons and episodes.
+    Contains information about a TV series.
     Use integer id from TMDB.
     All TMDB ids are unique within a collection,
     e.g. Movies, Series, Seasons, Episodes.
+    Seasons are stored as SeasonEntity children and loaded lazily.
     """
     json = ndb.JsonProperty(required=True)
-    seasons = ndb.PickleProperty()
+    # seasons used to be pickled into the series itself.
+    # only read for entities that haven't been migrated yet.
+    legacy_seasons = ndb.PickleProperty('seasons')
+    season_numbers = ndb.IntegerProperty(repeated=True, indexed=False)
     name = ndb.StringProperty()
     air_date = ndb.DateProperty()
     imdb_id = ndb.StringProperty()
     status = ndb.StringProperty()
+    # bumped by entities_to_put, for caches of what's derived from the series
+    version = ndb.IntegerProperty(default=0, indexed=False)
+
+    # the part of TMDB's json that we keep
+    JSON_KEYS = ('id', 'name', 'poster_path', 'backdrop_path', 'overview',
+        'first_air_date', 'number_of_seasons', 'number_of_episodes', 'status')
+    # fields patch compares and copies
+    PATCH_FIELDS = ('json', 'name', 'air_date', 'imdb_id', 'status')
+
+    def __init__(self, *args, **kwargs):
+        super(Series, self).__init__(*args, **kwargs)
+        self._seasons = dict() # season number to loaded Season
+        self._dirty_seasons = set() # season numbers that need a put
+        self._deleted_seasons = set() # season numbers that need a delete
+        self._legacy_loaded = False
 
     @classmethod
     def from_json(cls, json):
-        # don't store season info here
-        json.pop('seasons', None)
-
         air_date_str = json.get('first_air_date') or None;
-        air_date = (air_date_str and datetime.strptime(air_date_str, "%Y-%m-%d"))
+        air_date = (air_date_str and 
+            datetime.strptime(air_date_str, "%Y-%m-%d").date())
         external_ids = json.get('external_ids')
         imdb_id = (external_ids and external_ids.get('imdb_id'))
         
+        # don't store season info or anything else we don't use
         return cls(id=json.get('id'), 
-            json=json, 
-            seasons=dict(),
+            json={k:json.get(k) for k in cls.JSON_KEYS}, 
             name=json.get('name'),
             air_date=air_date,
             imdb_id=imdb_id,
             status=json.get('status'))
 
+    @classmethod
+    def get_multi(cls, series_ids):
+        """Gets several series in one batch, skipping missing ones"""
+        keys = [ndb.Key(cls, int(i)) for i in series_ids]
+        return [s for s in ndb.get_multi(keys) if s is not None]
+
     def to_json(self):
-        seasons_json = {k:v.to_json() for k,v in self.seasons.items()}
         json = {k:self.json[k] for k in 
             ('id', 'name', 'poster_path', 'first_air_date', 'number_of_seasons')}
-        json.update({'seasons':seasons_json})
+        json.update(self.seasons_json())
         return json
 
     def seasons_json(self):
-        seasons_json = {k:v.to_json() for k,v in self.seasons.items()}
+        seasons_json = {s.number():s.to_json() for s in self.iter_seasons()}
         json = {'seasons' : seasons_json}
         return json
 
@@ -78,33 +285,347 @@ class Series(ndb.Model):
     def poster(self):
         return self.json.get('poster_path')
 
+    def search_row(self):
+        """What search shows of the series, see SearchIndexSnapshot"""
+        return [self.get_id(), self.name, self.poster(), 
+            self.json.get('first_air_date')]
+
     def backdrop(self):
         return self.json.get('backdrop_path')
 
     def overview(self):
         return self.json.get('overview')
 
+    def season_details(self, season_number):
+        """Full TMDB json for a season, fetched on demand"""
+        return TMDB.season(self.get_id(), season_number)
+
+    def episode_details(self, season_number, episode_number):
+        """Full TMDB json for an episode, e.g. overview and still_path"""
+        return TMDB.episode(self.get_id(), season_number, episode_number)
+
+    def season_key(self, season_number):
+        # string id, ndb rejects the integer id 0 of Specials
+        return ndb.Key(SeasonEntity, '%d' % season_number, parent=self.key)
+
+    def _load_legacy(self):
+        """
+        Moves the seasons of an unmigrated series into the cache.
+        They get their own entities on the next put_all.
+        """
+        if self._legacy_loaded or self.legacy_seasons is None:
+            return
+        self._legacy_loaded = True
+        for i, season in self.legacy_seasons.items():
+            self._seasons.setdefault(i, season)
+            self._dirty_seasons.add(i)
+        self.season_numbers = sorted(
+            set(self.season_numbers) | set(self.legacy_seasons))
+
     def get_season(self, season_number):
-        return self.seasons.get(season_number)
+        self._load_legacy()
+        if season_number in self._seasons:
+            return self._seasons[season_number]
+        if season_number not in self.season_numbers:
+            return None
+
+        entity = self.season_key(season_number).get()
+        season = entity and entity.season
+        self._seasons[season_number] = season
+        return season
 
     def set_season(self, season):
-        self.seasons[season.number()] = season
+        self._load_legacy()
+        season_number = season.number()
+        if season_number not in self.season_numbers:
+            self.season_numbers.append(season_number)
+            self.season_numbers.sort()
+        self._seasons[season_number] = season
+        self._dirty_seasons.add(season_number)
+        self._deleted_seasons.discard(season_number)
+
+    def patch(self, json):
+        """
+        Copies fields from TMDB's series json.
+        Returns True if anything we store changed.
+        """
+        new = Series.from_json(json)
+        changed = False
+        for field in self.PATCH_FIELDS:
+            value = getattr(new, field)
+            if getattr(self, field) != value:
+                setattr(self, field, value)
+                changed = True
+        return changed
+
+    def patch_season(self, season):
+        """
+        Stores a refetched season if it differs from the stored one.
+        Returns True if it did.
+        """
+        if self.get_season(season.number()) == season:
+            return False
+        self.set_season(season)
+        return True
+
+    def remove_season(self, season_number):
+        """Returns True if the season was stored"""
+        self._load_legacy()
+        if season_number not in self.season_numbers:
+            return False
+        self.season_numbers.remove(season_number)
+        self._seasons.pop(season_number, None)
+        self._dirty_seasons.discard(season_number)
+        self._deleted_seasons.add(season_number)
+        return True
+
+    def load_seasons(self):
+        """Fetches every season that isn't loaded yet in one batch"""
+        self.load_seasons_multi([self])
+
+    @classmethod
+    def load_seasons_multi(cls, series_list):
+        """
+        Loads the seasons of several series with a single get_multi.
+        """
+        keys = list()
+        for series in series_list:
+            series._load_legacy()
+            keys.extend(series.season_key(i) for i in series.season_numbers
+                if i not in series._seasons)
+
+        series_by_key = {series.key:series for series in series_list}
+        for key, entity in zip(keys, ndb.get_multi(keys)):
+            series = series_by_key[key.parent()]
+            series._seasons[int(key.string_id())] = entity and entity.season
 
     def iter_seasons(self):
-        for i in sorted(self.seasons.keys()):
-            yield self.get_season(i)
+        self.load_seasons()
+        for i in self.season_numbers:
+            season = self.get_season(i)
+            if season is not None:
+                yield season
 
     def get_episode(self, season_number, episode_number):
         return self.get_season(season_number).get_episode(episode_number)
 
     def set_episode(self, season_number, episode):
         self.get_season(season_number).set_episode(episode)
+        self._dirty_seasons.add(season_number)
+
+    def entities_to_put(self):
+        """
+        Returns the series, every season changed since it was loaded,
+        and the series' serialized json. Bumps the version.
+        Loads every season, use load_seasons_multi first for several series.
+        """
+        # migrate: every legacy season gets its own entity
+        self._load_legacy()
+        self.legacy_seasons = None
+        self.version = (self.version or 0) + 1
+
+        entities = [self]
+        for i in sorted(self._dirty_seasons):
+            season = self._seasons.get(i)
+            if season is not None:
+                entities.append(SeasonEntity(key=self.season_key(i), 
+                    season=season))
+        entities.append(SeriesJsonEntity.materialize(self))
+        return entities
+
+    def keys_to_delete(self):
+        """Keys of seasons removed since the series was loaded"""
+        return [self.season_key(i) for i in sorted(self._deleted_seasons)]
+
+    def put_all(self):
+        """Puts the series along with its changed seasons"""
+        ndb.put_multi(self.entities_to_put())
+        ndb.delete_multi(self.keys_to_delete())
+        self._dirty_seasons.clear()
+        self._deleted_seasons.clear()
+
+class SeasonEntity(ndb.Model):
+    """
+    A Season of a Series, stored separately so the series header
+    can be read without unpickling every episode.
+    Parent is the Series, id is the season number as a string.
+    """
+    season = ndb.PickleProperty(required=True)
+
+class SeriesJsonEntity(ndb.Model):
+    """
+    Series.to_json, serialized and gzipped whenever the series is written,
+    so it can be served without building a dict for every episode.
+    Parent is the Series, id is ID.
+    """
+    ID = 1
+    version = ndb.IntegerProperty(indexed=False) # of the series
+    data = ndb.BlobProperty(required=True)
+
+    @classmethod
+    def key_for(cls, series_id):
+        return ndb.Key(cls, cls.ID, parent=ndb.Key(Series, int(series_id)))
+
+    @classmethod
+    def materialize(cls, series):
+        """Serializes a series with loaded seasons"""
+        data = json.dumps(series.to_json(), separators=(',',':'))
+        return cls(key=cls.key_for(series.get_id()), 
+            version=series.version,
+            data=gzip_compress(data))
+
+    @classmethod
+    def get_multi(cls, series_ids):
+        """
+        Returns the stored json of several series, in order.
+        Series written before json was stored get it now.
+        """
+        entities = ndb.get_multi([cls.key_for(i) for i in series_ids])
+        missing = [i for i, e in zip(series_ids, entities) if e is None]
+        if missing:
+            series_list = Series.get_multi(missing)
+            Series.load_seasons_multi(series_list)
+            materialized = [cls._put_if_newer(cls.materialize(s)) 
+                for s in series_list]
+            by_id = {e.key.parent().integer_id():e for e in materialized}
+            entities = [e or by_id.get(int(i)) 
+                for i, e in zip(series_ids, entities)]
+        return [e for e in entities if e is not None]
+
+    @staticmethod
+    @ndb.transactional
+    def _put_if_newer(entity):
+        """
+        Puts a backfilled entity unless a write of the series stored
+        the same or a later version meanwhile. Returns the one stored.
+        """
+        current = entity.key.get()
+        if current is not None and current.version >= entity.version:
+            return current
+        entity.put()
+        return entity
+
+    def get_id(self):
+        return self.key.parent().integer_id()
 
+    def json_str(self):
+        return gzip_decompress(self.data)
+
+class UpcomingEpisode(ndb.Model):
+    """
+    Index of recent and upcoming episodes, so "what's on next" is
+    a range query on air_date per series instead of a walk through
+    every season.
+    Parent is the Series, id is 'season-episode'.
+    Kept in step with the series by database.load_series and update_series.
+    """
+    air_date = ndb.DateProperty(required=True)
+    series_id = ndb.IntegerProperty(indexed=False)
+    series_name = ndb.StringProperty(indexed=False)
+    season_number = ndb.IntegerProperty(indexed=False)
+    episode_number = ndb.IntegerProperty(indexed=False)
+    name = ndb.StringProperty(indexed=False)
+
+    PAST_DAYS = 30 # episodes that aired before this when written aren't indexed
+
+    @classmethod
+    def key_for(cls, series, season_number, episode_number):
+        return ndb.Key(cls, '%d-%d' % (season_number, episode_number), 
+            parent=series.key)
+
+    @classmethod
+    def entities_for(cls, series):
+        """Index entries for the episodes of a series with loaded seasons"""
+        first = (date.today() - timedelta(cls.PAST_DAYS)).toordinal()
+        entities = list()
+        for season in series.iter_seasons():
+            for episode in season.iter_episodes():
+                if episode.air_ordinal() < first:
+                    continue
+                entities.append(cls(
+                    key=cls.key_for(series, season.number(), episode.number()),
+                    air_date=date.fromordinal(episode.air_ordinal()),
+                    series_id=series.get_id(),
+                    series_name=series.name,
+                    season_number=season.number(),
+                    episode_number=episode.number(),
+                    name=episode.name()))
+        return entities
+
+    @classmethod
+    def sync_multi(cls, series_list):
+        """
+        Returns the index entries to put and the keys to delete
+        to bring the index in line with written series.
+        """
+        existing = [cls.query(ancestor=s.key).fetch_async(keys_only=True) 
+            for s in series_list]
+        Series.load_seasons_multi(series_list)
+
+        to_put = list()
+        to_delete = list()
+        for series, keys in zip(series_list, existing):
+            entities = cls.entities_for(series)
+            current = set(e.key for e in entities)
+            to_put.extend(entities)
+            to_delete.extend(k for k in keys.get_result() if k not in current)
+        return to_put, to_delete
+
+    @classmethod
+    def airing(cls, series_ids, start, end):
+        """
+        Episodes of series_ids airing from start up to but not including end,
+        ordered by air date.
+        """
+        # one small ancestor query per series, so the cost follows
+        # the number of series asked for, not the whole catalogue
+        futures = [cls.query(cls.air_date >= start, cls.air_date < end,
+                ancestor=ndb.Key(Series, int(i))).fetch_async()
+            for i in set(series_ids)]
+        episodes = [e for f in futures for e in f.get_result()]
+        episodes.sort(key=lambda e: (e.air_date, e.series_name, 
+            e.season_number, e.episode_number))
+        return episodes
+
+    def to_json(self):
+        return {'series_id':self.series_id, 
+            'series_name':self.series_name,
+            'season_number':self.season_number,
+            'episode_number':self.episode_number,
+            'name':self.name,
+            'air_date':self.air_date.isoformat()}
+
+def date_ordinal(date_str):
+    """Converts 'YYYY-MM-DD' to a day ordinal. 0 if there's no date."""
+    if not date_str:
+        return 0
+    return datetime.strptime(date_str, "%Y-%m-%d").toordinal()
+
+def ordinal_date(ordinal):
+    """Converts a day ordinal back to 'YYYY-MM-DD'"""
+    if not ordinal:
+        return None
+    return date.fromordinal(ordinal).isoformat()
 
 class Season(object):
-    def __init__(self, json, episodes=dict()):
-        self.json = json
-        self.episodes = episodes
+    """
+    Compact record of a TMDB season.
+    Only what we display is kept, the rest can be fetched from
+    TMDB with Series.season_details.
+    Pickles to a tuple with its episodes packed into tuples.
+    """
+    __slots__ = ('_id', '_number', '_name', '_air_date', '_poster', 'episodes')
+
+    STATE_VERSION = 1
+
+    def __init__(self, season_id, number, name=None, air_date=0, 
+        poster=None, episodes=None):
+        self._id = season_id
+        self._number = number
+        self._name = name
+        self._air_date = air_date # day ordinal
+        self._poster = poster
+        self.episodes = episodes if episodes is not None else dict()
 
     @classmethod
     def from_json(cls, json):
@@ -112,32 +633,66 @@ class Season(object):
         TMDB includes episodes in their response for a season,
         so this method will also populate the episodes of a season.
         """
-        episodes_json = json.pop('episodes', None)
-        if episodes_json is None:
-            return cls(json=json)
+        season = cls(season_id=json.get('id'),
+            number=json.get('season_number'),
+            name=json.get('name'),
+            air_date=date_ordinal(json.get('air_date')),
+            poster=json.get('poster_path'))
+
+        for episode_json in json.get('episodes') or []:
+            season.set_episode(Episode.from_json(episode_json))
+
+        return season
+
+    def __getstate__(self):
+        episodes = tuple(e.pack() for e in self.iter_episodes())
+        return (self.STATE_VERSION, self._id, self._number, self._name,
+            self._air_date, self._poster, episodes)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # pickled before seasons were compact, state is the old __dict__
+            episodes = state.get('episodes') or dict()
+            self.__init__(**self._legacy_fields(state['json']))
+            for episode in episodes.values():
+                self.set_episode(episode)
+            return
 
-        episodes = dict()
-        for episode_json in episodes_json:
-            episode = Episode.from_json(episode_json)
-            episodes[episode.number()] = episode
+        (version, self._id, self._number, self._name, 
+            self._air_date, self._poster, episodes) = state
+        self.episodes = dict()
+        for packed in episodes:
+            self.set_episode(Episode.unpack(packed))
 
-        return cls(json=json, episodes=episodes)
+    @staticmethod
+    def _legacy_fields(json):
+        return {'season_id':json.get('id'), 
+            'number':json.get('season_number'),
+            'name':json.get('name'),
+            'air_date':date_ordinal(json.get('air_date')),
+            'poster':json.get('poster_path')}
+
+    def __eq__(self, other):
+        return (isinstance(other, Season) and 
+            self.__getstate__() == other.__getstate__())
+
+    def __ne__(self, other):
+        return not self == other
     
     def to_json(self):
         episode_json = {k:v.to_json() for k,v in self.episodes.items()}
-        json = {k:self.json[k] for k in ['id', 'air_date']}
+        json = {'id':self._id, 'air_date':self.air_date()}
         json.update({'episodes':episode_json})
         return json
 
-
     def get_id(self):
-        return self.json.get('id')
+        return self._id
 
     def name(self):
-        return self.json.get('name')
+        return self._name
 
     def number(self):
-        return self.json.get('season_number')
+        return self._number
 
     def number_of_episodes(self):
         """
@@ -146,10 +701,10 @@ class Season(object):
         return len(self.episodes)
 
     def air_date(self):
-        return self.json.get('air_date')
+        return ordinal_date(self._air_date)
 
     def poster(self):
-        return self.json.get('poster_path')
+        return self._poster
 
     def get_episode(self, episode_number):
         return self.episodes.get(episode_number)
@@ -162,45 +717,66 @@ class Season(object):
             yield self.get_episode(i)
 
 class Episode(object):
-    def __init__(self, json):
-        self.json = json
+    """
+    Compact record of a TMDB episode.
+    Overview, stills and credits are left on TMDB,
+    see Series.episode_details.
+    """
+    __slots__ = ('_id', '_number', '_name', '_air_date')
+
+    def __init__(self, episode_id, number, name=None, air_date=0):
+        self._id = episode_id
+        self._number = number
+        self._name = name
+        self._air_date = air_date # day ordinal
 
     @classmethod
     def from_json(cls, json):
-        return cls(json=json)
+        return cls(episode_id=json.get('id'),
+            number=json.get('episode_number'),
+            name=json.get('name'),
+            air_date=date_ordinal(json.get('air_date')))
+
+    def pack(self):
+        return (self._number, self._air_date, self._name, self._id)
+
+    @classmethod
+    def unpack(cls, packed):
+        number, air_date, name, episode_id = packed
+        return cls(episode_id, number, name, air_date)
+
+    def __getstate__(self):
+        return self.pack()
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # pickled before episodes were compact
+            state = Episode.from_json(state['json']).pack()
+        self._number, self._air_date, self._name, self._id = state
 
     def to_json(self):
-        json = {k:self.json[k] for k in 
-            ('name', 'air_date')}
+        json = {'name':self._name, 'air_date':self.air_date()}
         return json
 
     def get_id(self):
-        return self.json.get('id')
+        return self._id
 
     def number(self):
-        return self.json.get('episode_number')
+        return self._number
 
     def name(self):
-        return self.json.get('name')
+        return self._name
 
     def air_date(self):
-        return self.json.get('air_date')
+        return ordinal_date(self._air_date)
+
+    def air_ordinal(self):
+        return self._air_date
 
     def aired(self, within=7):
-        air_str = self.json.get('air_date')
-        if air_str is None:
+        if not self._air_date:
             return False
-        air_date = datetime.strptime(air_str, "%Y-%m-%d")
-        return air_date <= (datetime.now() + timedelta(within))
-
-    def overview(self):
-        return self.json.get('overview')
-
-    def still(self):
-        return self.json.get('still_path')
-
-    def season_number(self):
-        return self.json.get('season_number')
+        return self._air_date <= (date.today() + timedelta(within)).toordinal()
 
 class RatingCode:
     """
@@ -229,6 +805,12 @@ class RatingCode:
 #         self.value = value
 #         self.date = datetime.now()
 
+def epoch_seconds(dt):
+    return calendar.timegm(dt.timetuple())
+
+def from_epoch(seconds):
+    return datetime.utcfromtimestamp(seconds)
+
 class BaseRating(object):
     def __init__(self):
         self.rating = 0
@@ -244,6 +826,11 @@ class BaseRating(object):
         self.rated = datetime.now()
         self.rating = value
 
+    @classmethod
+    def _blank(cls):
+        """Instance without running __init__, used when unpacking"""
+        return cls.__new__(cls)
+
 
 class SeriesRating(BaseRating):
     def __init__(self, series_id, series_name, tracking=True):
@@ -259,13 +846,36 @@ class SeriesRating(BaseRating):
         ret.update({'seasons':{k:v.to_json() for k,v in self.seasons.items()}})
         return ret
 
+    def pack(self):
+        """
+        [name, tracking, rating, added, rated, {season: packed season}]
+        Times are epoch seconds.
+        """
+        seasons = {str(int(k)):v.pack() for k,v in self.seasons.items()}
+        return [self.name, int(self.tracking), self.rating, 
+            epoch_seconds(self.added), epoch_seconds(self.rated), seasons]
+
+    @classmethod
+    def unpack(cls, series_id, packed):
+        name, tracking, rating, added, rated, seasons = packed
+        series = cls._blank()
+        series.id = int(series_id)
+        series.name = name
+        series.tracking = bool(tracking)
+        series.rating = rating
+        series.added = from_epoch(added)
+        series.rated = from_epoch(rated)
+        series.seasons = {int(k):SeasonRating.unpack(v) 
+            for k,v in seasons.items()}
+        return series
+
     def set_tracking(self, value):
         if value is None:
             return
         self.tracking = value
 
     def get_season(self, season_number):
-        return self.seasons.setdefault(season_number, SeasonRating())
+        return self.seasons.setdefault(int(season_number), SeasonRating())
 
     def changes(self, c):
         self.rate(c.get('rating'))
@@ -292,8 +902,48 @@ class SeasonRating(BaseRating):
             {'episodes':{k:v.to_json() for k,v in self.episodes.items()}})
         return ret
 
+    def pack(self):
+        """
+        [rating, added, rated, watched bitset, {episode: [rating, rated]}]
+        Bit n of the bitset is set if episode n was watched.
+        Only rated episodes are listed, they keep their own rated time.
+        """
+        watched = 0
+        ratings = dict()
+        for k, episode in self.episodes.items():
+            k = int(k)
+            if episode.watched:
+                watched |= 1 << k
+            if episode.rating:
+                ratings[str(k)] = [episode.rating, epoch_seconds(episode.rated)]
+        return [self.rating, epoch_seconds(self.added), 
+            epoch_seconds(self.rated), watched, ratings]
+
+    @classmethod
+    def unpack(cls, packed):
+        rating, added, rated, watched, ratings = packed
+        season = cls._blank()
+        season.rating = rating
+        season.added = from_epoch(added)
+        season.rated = from_epoch(rated)
+        season.episodes = dict()
+
+        k = 0
+        while watched >> k:
+            if (watched >> k) & 1:
+                season.episodes[k] = EpisodeRating.unpack(
+                    True, 0, season.added, season.added)
+            k += 1
+        for k, (episode_rating, episode_rated) in ratings.items():
+            k = int(k)
+            episode = season.episodes.get(k)
+            season.episodes[k] = EpisodeRating.unpack(
+                episode is not None, episode_rating, season.added, 
+                from_epoch(episode_rated))
+        return season
+
     def get_episode(self, episode_number):
-        return self.episodes.setdefault(episode_number, EpisodeRating())
+        return self.episodes.setdefault(int(episode_number), EpisodeRating())
 
     def changes(self, c):
         self.rate(c.get('rating'))
@@ -317,6 +967,15 @@ class EpisodeRating(BaseRating):
         ret.update({'watched':self.watched})
         return ret
 
+    @classmethod
+    def unpack(cls, watched, rating, added, rated):
+        episode = cls._blank()
+        episode.watched = watched
+        episode.rating = rating
+        episode.added = added
+        episode.rated = rated
+        return episode
+
     def set_watched(self, value):
         if value is None:
             return
@@ -326,32 +985,380 @@ class EpisodeRating(BaseRating):
         self.rate(c.get('rating'))
         self.set_watched(c.get('watched'))
 
+class RatingTreeProperty(ndb.BlobProperty):
+    """
+    Stores a dict mapping series id to SeriesRating.
+    Encoded as a version byte followed by zlib compressed, packed json.
+    Values written by the old PickleProperty are unpickled and
+    rewritten in the current format on the next put.
+    """
+    VERSION = 1
+    PICKLE_PREFIX = '\x80' # pickle protocol 2
+
+    def _validate(self, value):
+        if not isinstance(value, dict):
+            raise datastore_errors.BadValueError(
+                "Expected a dict, got %r" % (value,))
+
+    def _encode(self, packed):
+        return (chr(self.VERSION) + 
+            zlib.compress(json.dumps(packed, separators=(',',':'))))
+
+    def _decode(self, value):
+        version = ord(value[0])
+        if version != self.VERSION:
+            raise ValueError("Unknown rating encoding version %d" % version)
+        return json.loads(zlib.decompress(value[1:]))
+
+    def _to_base_type(self, value):
+        return self._encode({str(k):v.pack() for k,v in value.items()})
+
+    def _from_base_type(self, value):
+        if value.startswith(self.PICKLE_PREFIX):
+            # round trip through pack to normalize the old tree
+            legacy = pickle.loads(value)
+            return {int(k):SeriesRating.unpack(k, v.pack()) 
+                for k,v in legacy.items()}
+
+        packed = self._decode(value)
+        return {int(k):SeriesRating.unpack(k, v) for k,v in packed.items()}
+
+class SeriesRatingProperty(RatingTreeProperty):
+    """A single SeriesRating, same encoding as RatingTreeProperty"""
+    def _validate(self, value):
+        if not isinstance(value, SeriesRating):
+            raise datastore_errors.BadValueError(
+                "Expected a SeriesRating, got %r" % (value,))
+
+    def _to_base_type(self, value):
+        return self._encode([value.id, value.pack()])
+
+    def _from_base_type(self, value):
+        series_id, packed = self._decode(value)
+        return SeriesRating.unpack(series_id, packed)
+
+class SeriesRatingEntity(ndb.Model):
+    """
+    A user's rating of one series.
+    Parent is the UserRating key, id is the series id.
+    Rating changes only rewrite the series they touch.
+    """
+    series = SeriesRatingProperty(required=True)
+    modified = ndb.DateTimeProperty(auto_now=True, indexed=False)
+    # to find the raters of a series when it's updated
+    series_id = ndb.IntegerProperty()
+    # progress, see summarize. None until first computed
+    summary = ndb.JsonProperty(indexed=False)
+    # bumped on every put, for caches of what's derived from the rating
+    version = ndb.IntegerProperty(default=0, indexed=False)
+
+    @classmethod
+    def new(cls, parent, series_id, series_name):
+        series_id = int(series_id)
+        return cls(parent=parent, id=series_id, 
+            series=SeriesRating(series_id, series_name))
+
+    def _pre_put_hook(self):
+        self.series_id = self.key.integer_id()
+        self.version = (self.version or 0) + 1
+
+    @staticmethod
+    def episodes_for(series_ids):
+        """
+        Maps series id to a list of (season, episode, air day ordinal)
+        of the stored series, in order. Specials are left out.
+        """
+        series_list = Series.get_multi(series_ids)
+        Series.load_seasons_multi(series_list)
+        return {s.get_id():[(season.number(), e.number(), e.air_ordinal()) 
+                for season in s.iter_seasons() if season.number() > 0
+                for e in season.iter_episodes()]
+            for s in series_list}
+
+    @staticmethod
+    def summarize(series_rating, episodes):
+        """
+        Counts aired and watched aired episodes, and finds the
+        next unwatched episode and the next air date.
+        episodes is an entry of episodes_for.
+        """
+        today = date.today().toordinal()
+        aired = watched = 0
+        next_unwatched = None
+        next_air = None
+        for season_number, episode_number, air in episodes:
+            season = series_rating.seasons.get(season_number)
+            episode = season and season.episodes.get(episode_number)
+            seen = bool(episode and episode.watched)
+            if air and air <= today:
+                aired += 1
+                watched += seen
+            elif air and (next_air is None or air < next_air):
+                next_air = air
+            if not seen and next_unwatched is None:
+                next_unwatched = [season_number, episode_number]
+        return {'aired':aired, 
+            'watched':watched, 
+            'next_unwatched':next_unwatched,
+            'next_air_date':ordinal_date(next_air) if next_air else None}
+
+    @staticmethod
+    def is_stale(summary):
+        """True if missing, or an episode aired since it was computed"""
+        if summary is None:
+            return True
+        next_air_date = summary.get('next_air_date')
+        return bool(next_air_date) and (
+            next_air_date <= date.today().isoformat())
+
 class UserRating(ndb.Model):
     """
     All ratings for a user.
     Uses the same integer_id as User.
+    Series ratings are SeriesRatingEntity children,
+    for_user loads them into series_ratings.
     """
-    # this will be a dict mapping series_id to SeriesRating
-    series_ratings = ndb.PickleProperty()
+    # ratings used to be stored in one tree here.
+    # only read for entities that haven't been migrated yet.
+    legacy_series_ratings = RatingTreeProperty('series_ratings')
     movie_ratings = ndb.PickleProperty()
+    # bumped with every write to the user's ratings, for ETags
+    version = ndb.IntegerProperty(default=0, indexed=False)
+
+    def __init__(self, *args, **kwargs):
+        super(UserRating, self).__init__(*args, **kwargs)
+        # this will be a dict mapping series_id to SeriesRating
+        self.series_ratings = dict()
+        # series_id to progress summary, see SeriesRatingEntity.summarize
+        self.summaries = dict()
+        # series_id to SeriesRatingEntity.version
+        self.versions = dict()
 
     @classmethod
     def new(cls, user):
         return cls(id=user.get_id(), 
-            series_ratings=dict(),
             movie_ratings=dict())
 
+    def _pre_put_hook(self):
+        self.version = (self.version or 0) + 1
+
+    @classmethod
+    def _touch(cls, key):
+        """
+        Call inside a transaction that writes ratings.
+        Returns the UserRating to put along, so its version is bumped.
+        """
+        return key.get() or cls(key=key, movie_ratings=dict())
+
+    @classmethod
+    def version_for(cls, user):
+        """Changes whenever any of the user's ratings are written"""
+        user_rating = cls.key_for(user).get()
+        return user_rating.version if user_rating else 0
+
+    @classmethod
+    def key_for(cls, user):
+        return ndb.Key(cls, user.get_id())
+
     @classmethod
     def for_user(cls, user):
         """
         Returns the UserRating object for a user.
         Creates a new one if user hasn't rated before.
         """
-        user_rating = cls.get_by_id(user.get_id())
+        key = cls.key_for(user)
+        user_rating_future = key.get_async()
+        entities = SeriesRatingEntity.query(ancestor=key).fetch()
+
+        user_rating = user_rating_future.get_result()
         if user_rating is None:
             user_rating = cls.new(user)
+        elif user_rating.legacy_series_ratings is not None:
+            entities = cls.migrate(key).values()
+            user_rating.legacy_series_ratings = None
+
+        for entity in entities:
+            user_rating.series_ratings[entity.key.integer_id()] = entity.series
+            user_rating.summaries[entity.key.integer_id()] = entity.summary
+            user_rating.versions[entity.key.integer_id()] = entity.version
         return user_rating
 
+    @classmethod
+    def _get_for_update(cls, key, series_ids):
+        """
+        Call inside a transaction.
+        Returns a dict mapping series id to SeriesRatingEntity (or None),
+        and a list of entities that have to be put to finish migrating
+        the user from the legacy rating tree.
+        """
+        series_keys = [ndb.Key(SeriesRatingEntity, int(i), parent=key) 
+            for i in series_ids]
+        entities = ndb.get_multi([key] + series_keys)
+        user_rating = entities.pop(0)
+
+        ratings = {k.integer_id():e for k,e in zip(series_keys, entities)}
+        to_put = list()
+        if user_rating and user_rating.legacy_series_ratings is not None:
+            for series_id, series in user_rating.legacy_series_ratings.items():
+                entity = SeriesRatingEntity(parent=key, id=series_id, 
+                    series=series)
+                ratings[series_id] = entity
+                to_put.append(entity)
+            user_rating.legacy_series_ratings = None
+            to_put.append(user_rating)
+
+        return ratings, to_put
+
+    @classmethod
+    @ndb.transactional
+    def migrate(cls, key):
+        """
+        Moves the legacy rating tree into SeriesRatingEntity children.
+        Returns a dict mapping series id to every SeriesRatingEntity.
+        """
+        ratings, to_put = cls._get_for_update(key, [])
+        ndb.put_multi(to_put)
+        if to_put:
+            logging.info("Migrated ratings of user %s" % key.string_id())
+            return ratings
+        return {e.key.integer_id():e 
+            for e in SeriesRatingEntity.query(ancestor=key).fetch()}
+
+    @classmethod
+    @ndb.transactional
+    def add_series(cls, user, series_id, series_name):
+        """
+        Returns True if the series was added
+        Returns False if user already rated it
+        """
+        key = cls.key_for(user)
+        ratings, to_put = cls._get_for_update(key, [series_id])
+        if ratings.get(int(series_id)):
+            ndb.put_multi(to_put)
+            return False
+
+        to_put.append(SeriesRatingEntity.new(key, series_id, series_name))
+        to_put.append(cls._touch(key))
+        ndb.put_multi(to_put)
+        return True
+
+    @classmethod
+    def update_series_ratings(cls, user_id, changes):
+        """
+        Applies a json object of changes, only writing the series in it.
+        Their progress summaries are recomputed along the way.
+        """
+        episodes = SeriesRatingEntity.episodes_for(changes.keys())
+        cls._update_series_ratings(user_id, changes, episodes)
+
+    @classmethod
+    @ndb.transactional
+    def _update_series_ratings(cls, user_id, changes, episodes):
+        """
+        Runs in a transaction, so concurrent writers retry on
+        top of each other instead of overwriting.
+        """
+        key = ndb.Key(cls, user_id)
+        ratings, to_put = cls._get_for_update(key, changes.keys())
+        to_put = {e.key:e for e in to_put}
+        for series_id, series_changes in changes.items():
+            entity = ratings.get(int(series_id))
+            if entity is None:
+                entity = SeriesRatingEntity.new(key, series_id, 
+                    series_changes.get("name"))
+            entity.series.changes(series_changes)
+            entity.summary = SeriesRatingEntity.summarize(entity.series, 
+                episodes.get(int(series_id), []))
+            to_put[entity.key] = entity
+        to_put[key] = cls._touch(key)
+
+        ndb.put_multi(to_put.values())
+
+    @classmethod
+    def refresh_summaries(cls, user_id, series_ids):
+        """
+        Recomputes the progress summaries of some of a user's series.
+        Returns a dict mapping series id to summary.
+        """
+        episodes = SeriesRatingEntity.episodes_for(series_ids)
+        return cls._refresh_summaries(user_id, series_ids, episodes)
+
+    @classmethod
+    @ndb.transactional
+    def _refresh_summaries(cls, user_id, series_ids, episodes):
+        key = ndb.Key(cls, user_id)
+        entities = ndb.get_multi([ndb.Key(SeriesRatingEntity, int(i), 
+            parent=key) for i in series_ids])
+        entities = [e for e in entities if e is not None]
+        for entity in entities:
+            entity.summary = SeriesRatingEntity.summarize(entity.series,
+                episodes.get(entity.key.integer_id(), []))
+        if entities:
+            ndb.put_multi(entities + [cls._touch(key)])
+        return {e.key.integer_id():e.summary for e in entities}
+
+    @classmethod
+    def refresh_series_summaries(cls, series_ids):
+        """
+        Recomputes the summaries of every user rating series_ids,
+        after the series were updated.
+        """
+        series_ids = [int(i) for i in series_ids]
+        keys = SeriesRatingEntity.query(
+            SeriesRatingEntity.series_id.IN(series_ids)).fetch(keys_only=True)
+        by_user = collections.defaultdict(list)
+        for k in keys:
+            by_user[k.parent().string_id()].append(k.integer_id())
+
+        episodes = SeriesRatingEntity.episodes_for(series_ids)
+        for user_id, user_series_ids in by_user.items():
+            cls._refresh_summaries(user_id, user_series_ids, episodes)
+        logging.info("Refreshed %d summaries of series %s" % 
+            (len(keys), series_ids))
+
+    @classmethod
+    def progress(cls, user):
+        """
+        Returns a dict mapping series id to progress summary,
+        recomputing the ones that are missing or out of date.
+        Rating trees are never decoded for fresh summaries.
+        """
+        key = cls.key_for(user)
+        summaries = {e.key.integer_id():e.summary 
+            for e in SeriesRatingEntity.query(ancestor=key).fetch()}
+        return cls._refresh_stale(key.string_id(), summaries)
+
+    @classmethod
+    def _refresh_stale(cls, user_id, summaries):
+        """Recomputes, in place, summaries that are missing or out of date"""
+        stale = [i for i, summary in summaries.items() 
+            if SeriesRatingEntity.is_stale(summary)]
+        if stale:
+            summaries.update(cls.refresh_summaries(user_id, stale))
+        return summaries
+
+    @classmethod
+    def backfill_summaries(cls, cursor=None, batch_size=100):
+        """
+        Summarizes a batch of series ratings written before summaries
+        existed, which also gives them the series_id that
+        refresh_series_summaries finds them by.
+        Returns the cursor for the next batch, or None when done.
+        """
+        entities, next_cursor, more = SeriesRatingEntity.query().fetch_page(
+            batch_size, start_cursor=cursor)
+
+        by_user = collections.defaultdict(list)
+        for entity in entities:
+            if entity.series_id is None or entity.summary is None:
+                by_user[entity.key.parent().string_id()].append(
+                    entity.key.integer_id())
+        for user_id, series_ids in by_user.items():
+            cls.refresh_summaries(user_id, series_ids)
+        logging.info("Backfilled summaries of %d users" % len(by_user))
+
+        return next_cursor if more else None
+
     def get_id(self):
         return self.key.string_id()
 
@@ -368,11 +1375,21 @@ class UserRating(ndb.Model):
         series_id = int(series_id)
         return self.series_ratings.get(series_id)
 
+    def refresh_stale_summaries(self):
+        """Call before get_all_series_json, so no outdated summary is sent"""
+        self._refresh_stale(self.get_id(), self.summaries)
+
     def get_all_series_json(self):
-        return {k:v.to_json() for k,v in self.series_ratings.items()}
+        json = {k:v.to_json() for k,v in self.series_ratings.items()}
+        for k, summary in self.summaries.items():
+            if k in json:
+                json[k]['summary'] = summary
+        return json
 
     def update_all_series(self, changes):
         """
+        Applies changes in memory only,
+        use update_series_ratings to store them.
         Changes is a json object
         """
         for series_id, series_changes in changes.items():
@@ -382,6 +1399,101 @@ class UserRating(ndb.Model):
 
             series.changes(series_changes)
 
+class RatingBuffer:
+    """
+    Write-behind buffer for rating changes.
+    Change sets from a user are merged in memcache and written to
+    the datastore together, by a flush task or once the buffer is big.
+    Changes are absolute values, so writing them twice is harmless.
+    The buffer only lives in memcache. Changes are lost if memcache
+    evicts it between add and flush, a window of about FLUSH_DELAY
+    plus queue latency, or if every retry of the flush task fails.
+    FLUSH_DELAY is kept short for that reason. If the flush task can't
+    be enqueued, TaskHandler.add_flush_ratings flushes inline, and
+    if memcache is unavailable add writes through.
+    """
+    PREFIX = 'rating-buffer:'
+    FLUSH_DELAY = 10 # seconds, countdown of the flush task
+    MAX_CHANGES = 200 # season and episode changes before flushing inline
+    RETRIES = 10
+
+    @classmethod
+    def key(cls, user_id):
+        return cls.PREFIX + user_id
+
+    @classmethod
+    def merge(cls, changes, more):
+        """Merges json object more into changes"""
+        for k, v in more.items():
+            if isinstance(v, dict) and isinstance(changes.get(k), dict):
+                cls.merge(changes[k], v)
+            else:
+                changes[k] = v
+        return changes
+
+    @staticmethod
+    def size(changes):
+        return sum(len(season.get('episodes', ())) + 1
+            for series in changes.values() 
+            for season in series.get('seasons', {}).values())
+
+    @classmethod
+    def pending(cls, user_id):
+        """Changes that haven't been written to the datastore yet"""
+        return memcache.get(cls.key(user_id)) or dict()
+
+    @classmethod
+    def add(cls, user_id, changes):
+        """
+        Merges changes into the buffer.
+        Returns True if a flush has to be scheduled, because the buffer
+        was empty or an inline flush of a big buffer didn't go through.
+        """
+        client = memcache.Client()
+        key = cls.key(user_id)
+        for _ in range(cls.RETRIES):
+            pending = client.gets(key)
+            if pending is None:
+                was_empty = True
+                merged = changes
+                if client.add(key, merged):
+                    break
+            else:
+                was_empty = not pending
+                merged = cls.merge(pending, changes)
+                if client.cas(key, merged):
+                    break
+        else:
+            # memcache is contended or down, write through.
+            # older buffered changes go first, or flushing them later
+            # would overwrite these
+            logging.warning("Rating buffer unavailable for %s" % user_id)
+            cls.flush(user_id)
+            UserRating.update_series_ratings(user_id, changes)
+            return False
+
+        if cls.size(merged) >= cls.MAX_CHANGES:
+            # if the buffer kept changing, leave it to the flush task
+            return not cls.flush(user_id)
+        return was_empty
+
+    @classmethod
+    def flush(cls, user_id):
+        """
+        Writes the buffered changes to the datastore.
+        Returns False if the buffer kept changing underneath us.
+        """
+        client = memcache.Client()
+        key = cls.key(user_id)
+        for _ in range(cls.RETRIES):
+            pending = client.gets(key)
+            if not pending:
+                return True
+            UserRating.update_series_ratings(user_id, pending)
+            if client.cas(key, dict()):
+                return True
+        return False
+
 class TmdbConfig(ndb.Model):
     """Storage place for config"""
     json = ndb.JsonProperty(required=True)
@@ -389,6 +1501,10 @@ class TmdbConfig(ndb.Model):
 
     STRING_ID = 'singleton'
     REFRESH_LATENCY = 30 # days
+    IMAGE_TYPES = ('poster', 'backdrop', 'still')
+
+    # (config, image urls) kept in instance memory
+    _cached = None
 
     @classmethod
     def refetch(cls):
@@ -397,72 +1513,179 @@ class TmdbConfig(ndb.Model):
         config.put()
         return config
 
+    @classmethod
+    def is_stale(cls, config):
+        return ((datetime.now() - config.last_modified) > 
+            timedelta(cls.REFRESH_LATENCY))
+
     @classmethod
     def get_config(cls):
-        """Checks if config is fresh. If not, refetch"""
+        """
+        Checks if config is fresh. If not, refetch.
+        Only hits the datastore once per instance while it's fresh.
+        """
+        cached = cls._cached
+        if cached and not cls.is_stale(cached[0]):
+            return cached[0]
+
         config = cls.get_by_id(cls.STRING_ID)
+        if not config or cls.is_stale(config):
+            config = cls.refetch()
 
-        if not config:
-            return cls.refetch()
+        cls._cached = (config, cls.build_image_urls(config))
+        return config
 
-        if ((config.last_modified - datetime.now()) > 
-            timedelta(cls.REFRESH_LATENCY)):
-            return cls.refetch()
+    @classmethod
+    def build_image_urls(cls, config):
+        """Maps image type to a list of base urls, one for each size"""
+        images = config.json.get('images')
+        base_url = images.get('base_url')
+        return {t:[base_url + size for size in images.get(t + '_sizes')]
+            for t in cls.IMAGE_TYPES}
 
-        return config
+    @classmethod
+    def image_urls(cls, image_type):
+        cls.get_config()
+        return cls._cached[1][image_type]
 
     @classmethod
     def poster_path(cls, size):
         # size between 0-6
-        images = cls.get_config().json.get('images')
-        return (images.get('base_url') + 
-            images.get('poster_sizes')[size])
+        return cls.image_urls('poster')[size]
 
     @classmethod
     def backdrop_path(cls, size):
         # size between 0-3
-        images = cls.get_config().json.get('images')
-        return (images.get('base_url') + 
-            images.get('backdrop_sizes')[size]) 
+        return cls.image_urls('backdrop')[size]
 
     @classmethod
     def still_path(cls, size):
         # size between 0-3
-        images = cls.get_config().json.get('images')
-        return (images.get('base_url') + 
-            images.get('still_sizes')[size])
+        return cls.image_urls('still')[size]
+
+class LoadResult:
+    """
+    Pseudoenum of what database.load_series did
+    """
+    LOADED = 'loaded' # this call stored the series
+    EXISTS = 'exists' # already stored, or stored by a concurrent load
+    LOADING = 'loading' # a concurrent load is still running
+    FAILED = 'failed' # TMDb failed, or the concurrent load did
 
 class database:
     """
     consolidated methods to interact w/ database
     """
-    @staticmethod
-    def load_series(series_id):
+    # bumped in memcache whenever a Series.search_row changes,
+    # so instances know to rebuild their search index
+    SEARCH_VERSION_KEY = 'search-version'
+
+    @classmethod
+    def search_changed(cls):
+        memcache.incr(cls.SEARCH_VERSION_KEY, initial_value=0)
+
+    @classmethod
+    def search_version(cls):
+        return memcache.get(cls.SEARCH_VERSION_KEY) or 0
+
+    # memcache lease held by whoever is loading a series
+    LOAD_LEASE_PREFIX = 'load-series-lease:'
+    LOAD_LEASE_TIME = 120 # seconds, in case the holder dies
+    LOAD_WAIT = 30 # seconds other callers wait for the holder
+    INTERACTIVE_LOAD_WAIT = 2 # seconds, for user facing requests
+    LOAD_POLL = 0.5 # seconds
+
+    @classmethod
+    def load_series(cls, series_id, interactive=False):
         """
         Loads series, season, episode into db.
+        Concurrent loads of the same series share one TMDb fetch,
+        callers without the lease wait for it to be released.
+        Interactive loads only wait briefly, for the lease and for
+        every TMDb fetch. If a fetch gives up nothing is stored.
+        Returns a LoadResult.
         """
+        series_id = int(series_id)
         #check if already in database
         series = Series.get_by_id(series_id)
         if series is not None:
             logging.info("Tried to re-add series %d" % series_id)
-            return False
+            # a retried load may have stored it, then failed to index it
+            if not TrackedSeries.contains(series_id):
+                TrackedSeries.add(series_id)
+            return LoadResult.EXISTS
+
+        lease_key = cls.LOAD_LEASE_PREFIX + str(series_id)
+        token = uuid.uuid4().hex
+        if not memcache.add(lease_key, token, time=cls.LOAD_LEASE_TIME):
+            logging.info("Waiting for another load of series %d" % series_id)
+            released = cls.wait_for_lease(lease_key, 
+                cls.INTERACTIVE_LOAD_WAIT if interactive else cls.LOAD_WAIT)
+            if cls.get_uncached(series_id) is not None:
+                return LoadResult.EXISTS
+            return LoadResult.FAILED if released else LoadResult.LOADING
+
+        try:
+            result = cls._load_series(series_id, 
+                INTERACTIVE_WAIT if interactive else None)
+            if result == LoadResult.LOADED:
+                cls.search_changed()
+            return result
+        finally:
+            if memcache.get(lease_key) == token:
+                memcache.delete(lease_key)
+
+    @classmethod
+    def wait_for_lease(cls, lease_key, wait):
+        """Returns False if the lease is still held after wait seconds"""
+        deadline = time.time() + wait
+        while memcache.get(lease_key) is not None:
+            if time.time() >= deadline:
+                return False
+            time.sleep(cls.LOAD_POLL)
+        return True
+
+    @staticmethod
+    def get_uncached(series_id):
+        """
+        Reads the series from the datastore itself. The caches may hold
+        a miss from before a concurrent load finished.
+        """
+        return Series.get_by_id(series_id, use_cache=False, use_memcache=False)
+
+    @classmethod
+    def _load_series(cls, series_id, max_wait=None):
+        # check again, another load may have finished before the lease
+        if cls.get_uncached(series_id) is not None:
+            return LoadResult.EXISTS
 
         # fetch from TMDB
-        series_json = TMDB.series(series_id)
+        series_json = TMDB.series(series_id, max_wait=max_wait)
         if not series_json:
-            return False;
+            return LoadResult.FAILED
 
         series = Series.from_json(series_json)
 
-        for i in range(1, series.number_of_seasons() + 1):
-            season_json = TMDB.season(series_id, season_number=i)
+        # fetch all seasons at once
+        season_numbers = range(1, series.number_of_seasons() + 1)
+        seasons_json = TMDB.seasons(series_id, season_numbers, 
+            max_wait=max_wait)
+        if max_wait is not None and not all(seasons_json.values()):
+            # don't store a series missing the seasons we gave up on
+            return LoadResult.FAILED
+        for i in season_numbers:
+            season_json = seasons_json.get(i)
             if not season_json:
                 continue
             season = Season.from_json(season_json)
             series.set_season(season)
 
-        series.put()
-        return True
+        series.put_all()
+        to_put, to_delete = UpcomingEpisode.sync_multi([series])
+        ndb.put_multi(to_put)
+        ndb.delete_multi(to_delete)
+        TrackedSeries.add(series.get_id())
+        return LoadResult.LOADED
 
     
     @staticmethod
@@ -471,56 +1694,194 @@ class database:
         Returns True if successful
         Returns False if already added
         """
-        user_rating = UserRating.for_user(user)
-        # check if already on watchlist
-        if user_rating.get_series(series_id):
-            return False
+        return UserRating.add_series(user, series_id, series_name)
 
-        user_rating.set_series(series_id, series_name)
-        user_rating.put()
-        return True
+    # TMDb change keys for things we store
+    SERIES_CHANGE_KEYS = frozenset(['name', 'overview', 'status', 
+        'first_air_date', 'images', 'poster_path', 'backdrop_path', 
+        'external_ids', 'imdb_id', 'number_of_seasons', 'number_of_episodes',
+        'season'])
 
     @classmethod
-    def update_series(cls, series_id):
+    def plan_update(cls, changes):
+        """
+        Reads a series' TMDb changes. Returns whether the series has to be
+        refetched, the numbers of seasons to refetch,
+        and the numbers of seasons that were deleted.
+        """
+        keys = set()
+        refetch_seasons = set()
+        deleted_seasons = set()
+        for change in changes or []:
+            keys.add(change.get('key'))
+            if change.get('key') != 'season':
+                continue
+            for item in change.get('items'):
+                season_number = (item.get('value') or {}).get('season_number')
+                if season_number is None:
+                    continue
+                if item.get('action') == 'deleted':
+                    deleted_seasons.add(season_number)
+                else:
+                    refetch_seasons.add(season_number)
+
+        refetch_series = bool(keys & cls.SERIES_CHANGE_KEYS)
+        return refetch_series, refetch_seasons - deleted_seasons, deleted_seasons
+
+    @staticmethod
+    def apply_update(series, series_json, seasons_json, deleted_seasons):
         """
-        Refetches series, and refetches its seasons IF it has changes
+        Patches series with refetched json.
+        Returns True if anything we store changed.
+        """
+        changed = False
+        if series_json:
+            changed = series.patch(series_json)
+        for season_json in seasons_json.values():
+            if season_json:
+                season = Season.from_json(season_json)
+                changed = series.patch_season(season) or changed
+        for season_number in deleted_seasons:
+            changed = series.remove_season(season_number) or changed
+        return changed
+
+    @classmethod
+    def update_series(cls, series_id, start_date=None):
+        """
+        Patches a series with what TMDb changed since start_date
+        (last 24h by default). Only refetches what changed,
+        and only writes if something we store is different.
+        Returns True if the series was written.
         """
         series_id = int(series_id)
-        series = Series.get_by_id(series_id)
-        seasons_changed = TMDB.seasons_changed_in_series(series_id)
-        for season_number in seasons_changed:
-            # refetch seasons that have changed
-            new_season = Season.from_json(
-                TMDB.season(series_id, season_number))
+        updated, failed = cls.update_series_batch([series_id], start_date)
+        if failed:
+            raise Exception("Couldn't get changes for series %d" % series_id)
+        return series_id in updated
 
-            # store the season
-            series.set_season(new_season)
+    @classmethod
+    def update_series_batch(cls, series_ids, start_date=None):
+        """
+        update_series for several series at once. TMDb is contacted
+        concurrently and every write goes out in one put_multi.
+        Returns the ids of series that were written,
+        and the ids of series whose changes couldn't be fetched.
+        """
+        timings = list()
+        stage_start = [time.time()]
+        def stage(name):
+            now = time.time()
+            timings.append("%s %.2fs" % (name, now - stage_start[0]))
+            stage_start[0] = now
+
+        series_list = Series.get_multi(series_ids)
+        stage("get")
+
+        all_changes = TMDB.series_changes_multi(
+            [s.get_id() for s in series_list], start_date)
+        stage("changes")
+
+        # plan what to refetch for each series
+        plans = dict()
+        urls = list()
+        failed = list()
+        for series in series_list:
+            series_id = series.get_id()
+            changes = all_changes.get(series_id)
+            if changes is None:
+                failed.append(series_id)
+                continue
+            refetch_series, refetch_seasons, deleted_seasons = cls.plan_update(
+                changes)
+            season_numbers = sorted(refetch_seasons)
+            series_url = TMDB.series_str(series_id) if refetch_series else None
+            season_urls = [TMDB.season_str(series_id, i) for i in season_numbers]
+            plans[series_id] = (series_url, season_numbers, season_urls, 
+                deleted_seasons)
+            urls.extend(season_urls)
+            if series_url:
+                urls.append(series_url)
+
+        # refetch, revalidating any cached response
+        fetched = dict(zip(urls, 
+            TMDB.fetch_json_multi(urls, ttl=SERIES_TTL, fresh=True)))
+        stage("fetch")
+
+        updated = list()
+        to_put = list()
+        to_delete = list()
+        rows_changed = False # search rows, see search_changed
+        for series in series_list:
+            plan = plans.get(series.get_id())
+            if plan is None:
+                continue
+            series_url, season_numbers, season_urls, deleted_seasons = plan
+            if any(fetched.get(url) is None for url in 
+                season_urls + ([series_url] if series_url else [])):
+                # retry rather than lose the change
+                failed.append(series.get_id())
+                continue
+            seasons_json = {i:fetched.get(url) 
+                for i, url in zip(season_numbers, season_urls)}
+            search_row = series.search_row()
+            if cls.apply_update(series, fetched.get(series_url), seasons_json, 
+                deleted_seasons):
+                updated.append(series)
+                rows_changed = (rows_changed or 
+                    series.search_row() != search_row)
+
+        # serializing needs every season
+        Series.load_seasons_multi(updated)
+        for series in updated:
+            to_put.extend(series.entities_to_put())
+            to_delete.extend(series.keys_to_delete())
+
+        index_put, index_delete = UpcomingEpisode.sync_multi(updated)
+        to_put.extend(index_put)
+        to_delete.extend(index_delete)
+        updated = [s.get_id() for s in updated]
+
+        ndb.put_multi(to_put)
+        ndb.delete_multi(to_delete)
+        if rows_changed:
+            cls.search_changed()
+        stage("put")
+
+        logging.info("Updated %d of %d series: %s. Timings: %s" % 
+            (len(updated), len(series_ids), updated, ", ".join(timings)))
+        return updated, failed
 
-        # refetch series
-        new_series = Series.from_json(TMDB.series(series_id))
-        
-        # store seasons
-        new_series.seasons = series.seasons
-        
-        new_series.put()
-        logging.info("Updated series: %s %s" % (series_id, series.name))
-        
-        return new_series
+    @staticmethod
+    def migrate_seasons(cursor=None, batch_size=20):
+        """
+        Moves pickled seasons of a batch of series into SeasonEntity children.
+        Returns the cursor for the next batch, or None when done.
+        """
+        series_list, next_cursor, more = Series.query().fetch_page(
+            batch_size, start_cursor=cursor)
+
+        entities = list()
+        for series in series_list:
+            if series.legacy_seasons is not None:
+                entities.extend(series.entities_to_put())
+        ndb.put_multi(entities)
+        logging.info("Migrated seasons of %d series" % 
+            len([e for e in entities if isinstance(e, Series)]))
+
+        return next_cursor if more else None
 
     @staticmethod
     def delete_all_entries():
         all_series_keys = Series.query().fetch(keys_only=True)
-        all_season_keys = list()
-        all_episode_keys = list()
-        for series_key in all_series_keys:
-            all_season_keys.extend(
-                Season.query(ancestor=series_key).fetch(keys_only=True))
-            all_episode_keys.extend(
-                Episode.query(ancestor=series_key).fetch(keys_only=True))
+        all_season_keys = SeasonEntity.query().fetch(keys_only=True)
+        all_upcoming_keys = UpcomingEpisode.query().fetch(keys_only=True)
+        all_json_keys = SeriesJsonEntity.query().fetch(keys_only=True)
 
         ndb.delete_multi(all_series_keys)
         ndb.delete_multi(all_season_keys)
-        ndb.delete_multi(all_episode_keys)
+        ndb.delete_multi(all_upcoming_keys)
+        ndb.delete_multi(all_json_keys)
+        ndb.Key(TrackedSeries, TrackedSeries.STRING_ID).delete()
 
         all_user_keys = User.query().fetch(keys_only=True)
         all_rating_keys = list()
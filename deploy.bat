@@ -0,0 +1,2 @@
+python templating.py && python C:\Programming\SDKs\Google\google_appengine/appcfg.py update .
+pause
\ No newline at end of file
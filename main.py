@@ -15,62 +15,79 @@
 # limitations under the License.
 #
 import webapp2
-import jinja2
+import hashlib
 import logging
-import os
-import pprint
 import json
-
-from oauth2client.appengine import OAuth2DecoratorFromClientSecrets
-from apiclient.discovery import build
-from google.appengine.api import memcache
-from google.appengine.api import taskqueue
-from webapp2_extras import routes
+import urllib
+from datetime import date, timedelta
 
 from database import *
 from utilities import *
-from tasks import TaskHandler
+from search import TvSearch, LocalIndex
+from templating import render_str, FragmentCache
 from tmdb import API_KEY as TMDB_KEY
 
-template_dir = os.path.join(os.path.dirname(__file__), 'templates')
-jinja_env = jinja2.Environment(loader = jinja2.FileSystemLoader(template_dir),
-                               autoescape = True,
-                               line_statement_prefix='#')
-
-SCOPE = (
-    'https://www.googleapis.com/auth/plus.login '
-    'https://www.googleapis.com/auth/userinfo.email')
-
-decorator = OAuth2DecoratorFromClientSecrets(
-    os.path.join(os.path.dirname(__file__), 'secrets', 'client_secret.json'), 
-    scope=SCOPE,
-    approval_prompt='force')
-
-def render_str(template, **params):
-    t = jinja_env.get_template(template)
-    return t.render(params)
-
 class BaseHandler(webapp2.RequestHandler):
     # cookie names
     param_id = 'user-id'
+    param_name = 'user-name' # display name, so most requests skip lookups
+    GZIP_MIN_SIZE = 1024 # bytes, smaller json is sent as is
+    # series change at most about twice a day, by the nightly sync
+    SERIES_MAX_AGE = 60 * 60 # seconds
 
     def write(self, *a, **kw):
         self.response.out.write(*a, **kw)
 
     def render_str(self, template, **params):
-        t = jinja_env.get_template(template)
-        return t.render(params)
+        return render_str(template, **params)
 
     def render(self, template, **kw):
         self.write(self.render_str(template, **kw))
 
     def render_json(self, d):
+        self.write_json(json.dumps(d))
+
+    def write_json(self, body):
+        """
+        Writes serialized json, gzipped if it's big enough to be worth it
+        and the client accepts gzip.
+        """
         self.response.headers['Content-Type'] = 'application/json; charset=UTF-8'
         # self.response.headers['Access-Control-Allow-Origin'] = '*'
-        self.write(json.dumps(d))
+        self.response.headers['Vary'] = 'Accept-Encoding'
+        if (len(body) >= self.GZIP_MIN_SIZE and 
+            'gzip' in self.request.headers.get('Accept-Encoding', '')):
+            self.response.headers['Content-Encoding'] = 'gzip'
+            body = gzip_compress(body)
+        self.write(body)
+
+    def write_gzipped_json(self, data):
+        """Writes json that is already gzipped, as is if the client accepts it"""
+        if 'gzip' not in self.request.headers.get('Accept-Encoding', ''):
+            self.write_json(gzip_decompress(data))
+            return
+        self.response.headers['Content-Type'] = 'application/json; charset=UTF-8'
+        self.response.headers['Vary'] = 'Accept-Encoding'
+        self.response.headers['Content-Encoding'] = 'gzip'
+        self.write(data)
+
+    def not_modified(self, etag, max_age=0):
+        """
+        Sets the validators of a response that stays the same as long
+        as etag does. Returns True after responding 304 if the client's
+        copy is current, so the response needn't be built.
+        """
+        etag = '"%s"' % etag
+        self.response.headers['ETag'] = etag
+        self.response.headers['Cache-Control'] = 'private, max-age=%d' % max_age
+        if etag in self.request.headers.get('If-None-Match', ''):
+            self.response.set_status(304)
+            return True
+        return False
 
     def render_pp_json(self, d):
         self.response.headers['Content-Type'] = 'application/json; charset=UTF-8'
+        import pprint
         self.write(pprint.pformat(d))
 
     def set_secure_cookie(self, name, val):
@@ -83,75 +100,48 @@ class BaseHandler(webapp2.RequestHandler):
         cookie_val = self.request.cookies.get(name)
         return cookie_val and check_secure_val(cookie_val)
 
-    def login(self, uid):
+    def set_name_cookie(self, uid, name):
+        # signed together with the id, so it can't be moved between users
+        self.set_secure_cookie(self.param_name, 
+            '%s:%s' % (uid, urllib.quote(name.encode('utf-8'))))
+
+    def read_name_cookie(self, uid):
+        val = self.read_secure_cookie(self.param_name)
+        if not val:
+            return None
+        name_uid, _, name = val.partition(':')
+        if name_uid != uid:
+            return None
+        return urllib.unquote(name).decode('utf-8')
+
+    def login(self, uid, name):
         self.set_secure_cookie(self.param_id, str(uid))
+        self.set_name_cookie(uid, name)
 
     def logout(self):
-        self.response.headers.add_header(
-            'Set-Cookie', '%s=; Path=/' % self.param_id)
+        for name in (self.param_id, self.param_name):
+            self.response.headers.add_header(
+                'Set-Cookie', '%s=; Path=/' % name)
 
     def initialize(self, *a, **kw):
         super(BaseHandler, self).initialize(*a, **kw)
-        # provides every BaseHandler subclass with a reference to the 
-        # current User
-        uid = str(self.read_secure_cookie(self.param_id))
-        
+        # provides every BaseHandler subclass with a UserContext
+        # of the current user, or None
+        self.user = None
+        uid = self.read_secure_cookie(self.param_id)
         if not uid:
-            self.user = None
             return
 
-        # TODO: is explicitly caching neccessary after switching to ndb?
-        self.user = memcache.get(uid)
-        if not self.user:
-            self.user = User.get_by_id(uid)
-            memcache.set(uid, self.user)
-
-class LoginHandler(BaseHandler):
-    @decorator.oauth_required
-    def get(self):
-        """
-        Sort of login and register.
-        First time user logs in they will be added to the db.
-        """
-        if not decorator.has_credentials():
-            # direct to oauth
-            url = decorator.authorize_url()
-            self.render('login.html', url=url)
+        name = self.read_name_cookie(uid)
+        if name is not None:
+            self.user = UserContext(uid, name)
             return
 
-        # check if still valid
-        credentials = decorator.get_credentials()
-        if credentials.access_token_expired:
-            logging.info("access token expired")
-            credentials.refresh(decorator.http())
-
-        # get user info w/ oauth2
-        service = build('plus', 'v1', http=decorator.http())
-        people_doc = service.people().get(userId='me').execute()
-        uid = str(people_doc.get('id'))
-        name = str(people_doc.get('displayName'))
-        
-        # login user w/ cookie
-        self.login(uid)
-
-        # add new user to database
-        if User.get_by_id(uid) is None:
-            user = User(
-                id=uid, 
-                name=name,
-                credentials=credentials)
-            user.put()
-
-        self.redirect('/')
-
-class LogoutHandler(BaseHandler):
-    @decorator.oauth_required
-    def get(self):
-        self.logout() # clear cookie
-        credentials = decorator.get_credentials()
-        credentials.revoke(decorator.http())
-        self.redirect('/')
-        
+        self.user = UserContext.for_id(uid)
+        if self.user:
+            # logged in before the name was in a cookie
+            self.set_name_cookie(uid, self.user.name)
+
 class MainHandler(BaseHandler):
     def get(self):
         # render search results
@@ -160,22 +150,33 @@ class MainHandler(BaseHandler):
             self.render('front.html', user=self.user)
             return
 
-        data = TMDB.search_tv(q)
-        if not data:
+        page = self.request.get('page', '1')
+        page = int(page) if page.isdigit() and int(page) > 0 else 1
+
+        results, total_pages = TvSearch.search(q, page)
+        if not results:
             self.render('front.html', 
                 user=self.user, 
                 q=q,
                 message="No Results.")
             return
 
-        series_list = list()
-        for series_json in data:
-            series_list.append(Series.from_json(series_json))
+        # the same for every user that is logged in. keyed by the results
+        # themselves, since the search cache expires long before fragments
+        poster_base = TmdbConfig.poster_path(2)
+        results_html, = FragmentCache.render_multi('front-results.html', 
+            [(FragmentCache.key('front-results', results, 
+                    self.user is not None, poster_base), 
+                {'poster_base':poster_base, 'user':self.user, 
+                    'series_list':results})])
 
         self.render('front.html',
-            poster_base=TmdbConfig.poster_path(2),
             user=self.user, 
-            series_list=series_list)
+            q=q,
+            q_url=urllib.quote(q.encode('utf-8')),
+            page=page,
+            total_pages=total_pages,
+            results_html=results_html)
             
     def post(self):
         if self.user is None:
@@ -187,6 +188,7 @@ class MainHandler(BaseHandler):
         series_name = self.request.get('series_name')
 
         if series_id:
+            from tasks import TaskHandler
             TaskHandler.add_load_series(series_id)
             added_to_watchlist = database.watchlist_series(
                 series_id, series_name, self.user)
@@ -198,17 +200,43 @@ class MainHandler(BaseHandler):
                 user=self.user, 
                 message="Already in watchlist")
             
+class SearchHandler(BaseHandler):
+    """
+    Exposes cached TMDb search results as json, /search/tv?q=&page=
+    """
+    def get(self, *a):
+        if self.user is None:
+            self.error(401)
+            return
+
+        page = self.request.get('page', '1')
+        page = int(page) if page.isdigit() and int(page) > 0 else 1
+        self.render_json(TvSearch.search_json(self.request.get('q'), page))
+
+class LocalSearchHandler(BaseHandler):
+    """
+    Typeahead over series we store, /search/local?q=
+    Falls back to TMDb when nothing local matches.
+    """
+    def get(self, *a):
+        if self.user is None:
+            self.error(401)
+            return
+
+        self.render_json(LocalIndex.search_json(self.request.get('q')))
+
+class WarmupHandler(webapp2.RequestHandler):
+    """Loads the local search index before the instance gets traffic"""
+    def get(self):
+        LocalIndex.get_index()
+
 class AccountHandler(BaseHandler):
     def get(self):
         if self.user is None:
             self.redirect("/")
             return
 
-        poster_path_str = ""
-        for i in range(7):
-            poster_path_str += TmdbConfig.poster_path(i) + " "
-
-        poster_path_str = poster_path_str.rstrip(" ")
+        poster_path_str = " ".join(TmdbConfig.image_urls('poster'))
 
         self.render('my-shows.html', 
             poster_paths=poster_path_str, 
@@ -224,43 +252,100 @@ class WatchedHandler(BaseHandler):
         self.render('my-shows.html', img_url=TmdbConfig.poster_path(0))
 
 class WatchlistHandler(BaseHandler):
+    PAGE_SIZE = 20
+
     def get(self):
-        # TODO: implement paging
         if self.user is None:
             self.redirect('/')
+            return
+
+        page = self.request.get('page', '0')
+        page = int(page) if page.isdigit() else 0
+        sort = self.request.get('sort', 'name')
 
         user_rating = UserRating.for_user(self.user)
-        series_rated = ([Series.get_by_id(series_id) 
-            for series_id in iter(user_rating.series_ratings)])
-        # TODO: implement sorting options here
-        
-        if not series_rated:
+        pending = RatingBuffer.pending(self.user.get_id())
+        user_rating.update_all_series(pending)
+        if not user_rating.series_ratings:
             self.write("Nothing on watchlist<br>")
             self.write("<a href='/'>Home</a>")
             return
 
+        start = page * self.PAGE_SIZE
+        end = start + self.PAGE_SIZE
+        if sort == 'air_date':
+            # series headers are small, get them all in one batch
+            series_rated = Series.get_multi(user_rating.series_ratings.keys())
+            series_rated.sort(key=lambda s: s.air_date, reverse=True)
+            series_rated = series_rated[start:end]
+        else:
+            # names are already in the ratings, only get the page
+            ratings = sorted(user_rating.series_ratings.values(), 
+                key=lambda r: (r.name or '').lower())
+            series_rated = Series.get_multi([r.id for r in ratings[start:end]])
+
+        # headers are shared by every user, seasons depend on the rating.
+        # episodes shown depend on the day, through Episode.aired
+        today = date.today().toordinal()
+        headers = FragmentCache.render_multi('watchlist-series.html', 
+            [(FragmentCache.key('watchlist-series', s.get_id(), s.version), 
+                {'series':s}) for s in series_rated])
+        seasons = list()
+        for s in series_rated:
+            series_id = s.get_id()
+            key = None
+            if str(series_id) not in pending:
+                key = FragmentCache.key('watchlist-seasons', 
+                    self.user.get_id(), series_id, s.version, 
+                    user_rating.versions.get(series_id), today)
+            seasons.append((key, {'series':s, 
+                'series_rating':user_rating.get_series(series_id)}))
+        # only series that have to be rendered need their seasons
+        seasons = FragmentCache.render_multi('watchlist-seasons.html', 
+            seasons, before_render=lambda misses: Series.load_seasons_multi(
+                [params['series'] for params in misses]))
+
         self.render('watchlist.html', 
-            series_rated=series_rated, 
-            ur=user_rating)
+            series_blocks=zip(headers, seasons), 
+            sort=sort,
+            page=page,
+            has_next=end < len(user_rating.series_ratings))
 
     def post(self):
         if not self.user:
             self.redirect('/account/watchlist')
+            return
 
-        user_rating = UserRating.for_user(self.user)
-        watched_id = int(self.request.get('watched_id'))
-        series_div = self.request.get('series_div')
         id_type = self.request.get('id_type')
+        try:
+            series_id = int(self.request.get('series_div'))
+            season_number = int(self.request.get('season_number'))
+            if id_type != 'season':
+                episode_numbers = [int(self.request.get('episode_number'))]
+        except ValueError:
+            self.error(400)
+            return
 
-        rating = BaseRating(watched_id, RatingCode.WATCHED)
         if id_type == 'season':
-            user_rating.set_season(rating)
-        elif id_type == 'episode':
-            user_rating.set_episode(rating)
-
-        user_rating.put()
-
-        self.redirect('/account/watchlist#' + series_div)
+            # the series or season may be gone since the page was rendered
+            series = Series.get_by_id(series_id)
+            season = series.get_season(season_number) if series else None
+            if season is None:
+                self.error(404)
+                return
+            episode_numbers = [e.number() for e in season.iter_episodes() 
+                if e.aired()]
+
+        # keys are strings, like the json the client posts
+        episodes = {str(n):{'watched':True} for n in episode_numbers}
+        changes = {str(series_id):
+            {'seasons':{str(season_number):{'episodes':episodes}}}}
+        uid = self.user.get_id()
+        if RatingBuffer.add(uid, changes):
+            from tasks import TaskHandler
+            TaskHandler.add_flush_ratings(uid)
+
+        self.redirect('/account/watchlist#%d' % series_id)
 
 class SeriesHandler(BaseHandler):
     """
@@ -273,11 +358,16 @@ class SeriesHandler(BaseHandler):
 
         series_id = int(kw.get('id'))
 
-        s = Series.get_by_id(series_id)
-        if s:
-            self.render_json(s.to_json())
-        else:
+        # json is serialized when the series is written
+        stored = SeriesJsonEntity.get_multi([series_id])
+        if not stored:
             self.render_json({})
+            return
+
+        if self.not_modified('series-%d-%d' % (series_id, stored[0].version), 
+            self.SERIES_MAX_AGE):
+            return
+        self.write_gzipped_json(stored[0].data)
 
     def post(self, *a, **kw):
         """
@@ -285,14 +375,85 @@ class SeriesHandler(BaseHandler):
         database.load_series is synchronous, so it can take a few seconds.
         This is desirable to allow the user to know when 
         the series has been copied from tmdb.
+        If it can't be done quickly, answers 202 with result 'loading'
+        and the client polls until the series is there.
         """
         if self.user is None:
             self.error(401)
             return
 
         series_id = int(kw.get('id'))
-        database.load_series(series_id)
-            
+        result = database.load_series(series_id, interactive=True)
+        if result == LoadResult.FAILED:
+            # TMDb failed or was too busy, a task retries
+            from tasks import TaskHandler
+            TaskHandler.add_load_series(series_id)
+            result = LoadResult.LOADING
+        if result == LoadResult.LOADING:
+            self.response.set_status(202)
+        self.render_json({'id':series_id, 'result':result})
+
+
+class SeriesListHandler(BaseHandler):
+    """
+    Exposes json for several Series at once, /series?ids=1,2,3
+    Responds with an object mapping series id to series json.
+    """
+    MAX_IDS = 100
+
+    def get(self, *a):
+        if self.user is None:
+            self.error(401)
+            return
+
+        ids = self.request.get('ids').split(',')
+        ids = [int(i) for i in ids if i.isdigit()][:self.MAX_IDS]
+
+        # json is serialized when the series is written
+        stored = SeriesJsonEntity.get_multi(ids)
+        found = dict((s.get_id(), s.version) for s in stored)
+        versions = ','.join('%d-%s' % (i, found.get(i)) for i in ids)
+        # a missing series may be loading, don't let the client keep
+        # a response without it
+        max_age = self.SERIES_MAX_AGE if len(found) == len(set(ids)) else 0
+        if self.not_modified(hashlib.sha1(versions).hexdigest(), max_age):
+            return
+
+        self.write_json('{%s}' % ','.join('"%d":%s' % 
+            (s.get_id(), s.json_str()) for s in stored))
+
+class ProgressHandler(BaseHandler):
+    """
+    Progress summary of every series the user rates, /account/progress
+    Responds with an object mapping series id to summary.
+    """
+    def get(self):
+        if self.user is None:
+            self.error(401)
+            return
+
+        self.render_json(UserRating.progress(self.user))
+
+class UpNextHandler(BaseHandler):
+    """
+    Episodes of the user's series airing in the next few days,
+    /account/upnext?days=7
+    """
+    MAX_DAYS = 60
+
+    def get(self):
+        if self.user is None:
+            self.error(401)
+            return
+
+        days = self.request.get('days', '7')
+        days = min(int(days), self.MAX_DAYS) if days.isdigit() else 7
+        keys = SeriesRatingEntity.query(
+            ancestor=UserRating.key_for(self.user)).fetch(keys_only=True)
+        start = date.today()
+        episodes = UpcomingEpisode.airing([k.integer_id() for k in keys], 
+            start, start + timedelta(days))
+        self.render_json([e.to_json() for e in episodes])
 
 class RatingHandler(BaseHandler):
     def get(self):
@@ -300,7 +461,20 @@ class RatingHandler(BaseHandler):
             self.error(401)
             return
 
+        # changes still in the write-behind buffer are part of the response
+        pending = RatingBuffer.pending(self.user.get_id())
+        # summaries go stale as episodes air, so the day is part of it too
+        etag = 'ratings-%s-%d-%s' % (self.user.get_id(), 
+            UserRating.version_for(self.user), date.today().isoformat())
+        if pending:
+            etag += '-' + hashlib.sha1(
+                json.dumps(pending, sort_keys=True)).hexdigest()
+        if self.not_modified(etag):
+            return
+
         ratings = UserRating.for_user(self.user)
+        ratings.refresh_stale_summaries()
+        ratings.update_all_series(pending)
         self.render_json(ratings.get_all_series_json())
 
     def post(self):
@@ -309,19 +483,29 @@ class RatingHandler(BaseHandler):
             return
 
         jDict = json.loads(self.request.body)
-        ratings = UserRating.for_user(self.user)
-
-        ratings.update_all_series(jDict)
-        ratings.put()
+        uid = self.user.get_id()
+        if RatingBuffer.add(uid, jDict):
+            from tasks import TaskHandler
+            TaskHandler.add_flush_ratings(uid)
 
 app = webapp2.WSGIApplication([
     ('/', MainHandler),
-    ('/login/?', LoginHandler),
-    ('/logout/?', LogoutHandler),
+    # handlers named by string are imported on their first request
+    ('/login/?', 'auth.LoginHandler'),
+    ('/logout/?', 'auth.LogoutHandler'),
     ('/account/?', AccountHandler),
     ('/account/watchlist/?', WatchlistHandler),
     ('/account/watched/?', WatchedHandler),
+    webapp2.Route(r'/search/tv<:/?>', handler=SearchHandler),
+    webapp2.Route(r'/search/local<:/?>', handler=LocalSearchHandler),
+    webapp2.Route(r'/series<:/?>', handler=SeriesListHandler),
     webapp2.Route(r'/series/<id:\d+><:/?>', handler=SeriesHandler),
     ('/account/rating/?', RatingHandler),
-    (decorator.callback_path, decorator.callback_handler())
+    ('/account/upnext/?', UpNextHandler),
+    ('/account/progress/?', ProgressHandler),
+    ('/oauth2callback', 'auth.OAuth2CallbackHandler'),
+    ('/_ah/warmup', WarmupHandler)
 ], debug=True)
+
+import appengine_config
+appengine_config.report_startup('main')
@@ -0,0 +1,174 @@
+import collections
+import hashlib
+import logging
+import re
+import time
+
+from google.appengine.api import memcache
+
+from database import database, Series, SearchIndexSnapshot
+from tmdb import TMDB, INTERACTIVE_WAIT
+
+SearchResult = collections.namedtuple('SearchResult', 
+    'id name poster_path first_air_date')
+
+class TvSearch:
+    """
+    Searches TMDb for series.
+    Pages of results are cached in memcache by normalized query,
+    as lightweight SearchResult tuples.
+    """
+    PREFIX = 'tv-search:'
+    TTL = 60 * 60 # seconds
+
+    @staticmethod
+    def normalize(query):
+        """Lowercase with single spaces, so equivalent queries share a key"""
+        return u' '.join(query.lower().split())
+
+    @classmethod
+    def key(cls, query, page):
+        # queries can be longer than memcache keys
+        digest = hashlib.sha1(query.encode('utf-8')).hexdigest()
+        return '%s%s:%d' % (cls.PREFIX, digest, page)
+
+    @classmethod
+    def search(cls, query, page=1):
+        """
+        Returns a list of SearchResult, and the total number of pages.
+        """
+        query = cls.normalize(query)
+        if not query:
+            return [], 0
+
+        key = cls.key(query, page)
+        cached = memcache.get(key)
+        if cached is not None:
+            return cached
+
+        data = TMDB.search_tv_page(query.encode('utf-8'), page, 
+            max_wait=INTERACTIVE_WAIT)
+        if data is None:
+            # don't cache failures
+            return [], 0
+
+        results = [SearchResult(r.get('id'), r.get('name'), 
+            r.get('poster_path'), r.get('first_air_date')) 
+            for r in data.get('results') or []]
+        value = (results, data.get('total_pages') or 0)
+        memcache.set(key, value, time=cls.TTL)
+        logging.info("Cached search %r page %d" % (query, page))
+        return value
+
+    @classmethod
+    def search_json(cls, query, page=1):
+        """Same shape as TMDb's response, for the client"""
+        results, total_pages = cls.search(query, page)
+        return {'page':page, 
+            'total_pages':total_pages,
+            'results':[r._asdict() for r in results]}
+
+class LocalIndex:
+    """
+    In-memory prefix index over the series we store,
+    for typeahead without contacting TMDb or the datastore.
+    Loaded from the SearchIndexSnapshot that a task rebuilds after
+    names, posters or air dates of series change. Instances check
+    database.search_version at most every CHECK_INTERVAL, and on warmup.
+    """
+    MAX_PREFIX = 10 # longer query tokens are checked against the names
+    LIMIT = 10
+    CHECK_INTERVAL = 60 # seconds
+
+    # (snapshot version, checked time, prefix to set of ids, id to SearchResult)
+    _index = None
+
+    @staticmethod
+    def tokenize(name):
+        return re.findall(r'\w+', name.lower(), re.UNICODE)
+
+    @staticmethod
+    def build_snapshot():
+        """Reads every series into the snapshot, run in a task"""
+        version = database.search_version()
+        rows = [s.search_row() 
+            for s in Series.query().iter(batch_size=500) if s.name]
+        SearchIndexSnapshot.save(version, rows)
+        logging.info("Built local search snapshot of %d series" % len(rows))
+
+    @classmethod
+    def build(cls, version, rows):
+        prefixes = collections.defaultdict(set)
+        results = dict()
+        for row in rows:
+            result = SearchResult(*row)
+            results[result.id] = result
+            for token in cls.tokenize(result.name):
+                for i in range(1, min(len(token), cls.MAX_PREFIX) + 1):
+                    prefixes[token[:i]].add(result.id)
+        return (version, time.time(), dict(prefixes), results)
+
+    @classmethod
+    def get_index(cls):
+        """
+        Returns the index, loading a newer snapshot if there is one.
+        Never reads the series themselves, an outdated snapshot
+        is served while a task rebuilds it.
+        """
+        index = cls._index
+        if index is not None and time.time() - index[1] < cls.CHECK_INTERVAL:
+            return index
+
+        # versions are compared for equality, memcache may reset them
+        version = database.search_version()
+        if index is None or index[0] != version:
+            snapshot = SearchIndexSnapshot.load()
+            if snapshot is None or snapshot[0] != version:
+                from tasks import TaskHandler
+                TaskHandler.add_build_search_snapshot(version)
+            if snapshot is not None and (
+                index is None or snapshot[0] != index[0]):
+                index = cls.build(*snapshot)
+
+        if index is None:
+            # nothing built yet, searches fall back to TMDb
+            index = (-1, time.time(), dict(), dict())
+        index = (index[0], time.time()) + index[2:]
+        cls._index = index
+        return index
+
+    @classmethod
+    def search(cls, query):
+        """
+        Returns SearchResults for stored series with a word starting
+        with each word of query, sorted by name.
+        """
+        tokens = cls.tokenize(query)
+        if not tokens:
+            return []
+
+        version, checked, prefixes, results = cls.get_index()
+        ids = None
+        for token in tokens:
+            matches = prefixes.get(token[:cls.MAX_PREFIX], set())
+            if len(token) > cls.MAX_PREFIX:
+                matches = set(i for i in matches if any(t.startswith(token) 
+                    for t in cls.tokenize(results[i].name)))
+            ids = matches if ids is None else ids & matches
+            if not ids:
+                return []
+
+        return sorted((results[i] for i in ids), 
+            key=lambda r: r.name.lower())[:cls.LIMIT]
+
+    @classmethod
+    def search_json(cls, query):
+        """
+        Local results if there are any, otherwise the first page from TMDb.
+        """
+        results = cls.search(query)
+        if results:
+            return {'source':'local', 'results':[r._asdict() for r in results]}
+        response = TvSearch.search_json(query)
+        response['source'] = 'tmdb'
+        return response
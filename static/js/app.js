@@ -123,15 +123,34 @@ angular.module("app", ["ui.bootstrap", "ngAnimate", "services", "directives", "n
                 return ($scope.unwatchedEpisodes===0) && ($scope.nextAirDate === undefined);
             }
 
+            $scope.unwatchedEpisodes = 0; // seen all aired episodes
+            $scope.nextAirDate = undefined; // no unaired episodes
+
+            // the server keeps a progress summary, so collapsed series
+            // don't have to walk every episode
+            var summary = $scope.seriesRating.summary;
+            $scope.initialized = false; // ratings filled in for every episode
+            if (summary) {
+                $scope.unwatchedEpisodes = summary.aired - summary.watched;
+                $scope.nextAirDate = convertDate(summary.next_air_date);
+            }
+
+            var initRatings = function() {
+                if ($scope.initialized || !$scope.seriesJson.id) return;
+                $scope.initialized = true;
+                Ratings.initSeries($scope.seriesJson);
+                updateUnwatchedUnairedCount();
+            };
+
             Series.get($scope.seriesRating.id).then(function success(data){
-                console.log()
                 $scope.seriesJson = data;
-                Ratings.initSeries(data);
-                updateUnwatchedUnairedCount();
+                if (!summary || !$scope.isCollapsed) initRatings();
+            });
+
+            $scope.$watch("isCollapsed", function(collapsed) {
+                if (!collapsed) initRatings();
             });
 
-            $scope.unwatchedEpisodes = 0; // seen all aired episodes
-            $scope.nextAirDate = undefined; // no unaired episodes
             var updateUnwatchedUnairedCount = function() {
                 var unwatchedEpisodes = 0;
                 var nextAirDate = undefined;
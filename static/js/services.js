@@ -19,32 +19,89 @@ angular.module("services", [])
         return new Date(dateStr[0], dateStr[1]-1, dateStr[2]);
     };
 }])
-.factory("Series", ["$http", "convertDate", function seriesFactory($http, convertDate) {
+.factory("Series", ["$http", "$q", "$timeout", "convertDate", 
+    function seriesFactory($http, $q, $timeout, convertDate) {
+    // series requested in the same digest are fetched in one request
+    var maxIds = 100; // same as SeriesListHandler.MAX_IDS
+    var promises = {}; // id -> promise of series json
+    var queued = {}; // id -> deferred, waiting for the next batch
+    var batchPromise = undefined;
+
+    function fetchBatch(ids, deferreds) {
+        $http.get("/series", {params: {ids: ids.join(",")}})
+            .then(function success(result) {
+                for (var id of ids) {
+                    var seriesJson = result.data[id] || {};
+                    if (!(id in result.data)) {
+                        // may still be loading, ask again next time
+                        delete promises[id];
+                    }
+                    console.log("loaded series: " + id);
+                    deferreds[id].resolve(parseAiredDates(seriesJson, convertDate));
+                }
+            }, function failure(result) {
+                for (var id of ids) {
+                    delete promises[id];
+                    deferreds[id].reject(result);
+                }
+            });
+    }
+
+    // series the server loads in a task are polled for
+    var loadPollMs = 2000;
+    var loadPollTries = 15;
+
+    function waitForLoad(id, tries) {
+        return $timeout(angular.noop, loadPollMs).then(function() {
+            return $http.get("/series", {params: {ids: id}});
+        }).then(function success(result) {
+            if (id in result.data) {
+                console.log("posted series: " + id);
+            } else if (tries > 1) {
+                return waitForLoad(id, tries - 1);
+            } else {
+                return $q.reject("series " + id + " didn't load");
+            }
+        });
+    }
+
+    function fetchQueued() {
+        var deferreds = queued;
+        var ids = Object.keys(deferreds);
+        queued = {};
+        batchPromise = undefined;
+        for (var i = 0; i < ids.length; i += maxIds) {
+            fetchBatch(ids.slice(i, i + maxIds), deferreds);
+        }
+    }
+
     return {
         get: function(id) {
-            return $http.get("/series/" + id, {cache: true})
-                .then(function success(result) {
-                    var seriesJson = result.data;
-                    console.log("loaded series: " + seriesJson.id);
-                    return parseAiredDates(seriesJson, convertDate);
-                });
+            if (!(id in promises)) {
+                queued[id] = $q.defer();
+                promises[id] = queued[id].promise;
+                batchPromise = batchPromise || $timeout(fetchQueued, 0);
+            }
+            return promises[id];
         },
         post: function(id) {
             return $http.post("/series/" + id, {})
-                .then(function success() {
+                .then(function success(result) {
+                    if (result.data.result === "loading") {
+                        return waitForLoad(id, loadPollTries);
+                    }
                     console.log("posted series: " + id);
                 });
         }
     };
 }])
-.factory("searchTv", ["$http", "tmdbKey", function($http, tmdbKey) {
-    var searchStr = 'http://api.themoviedb.org/3/search/tv?api_key=' 
-        + tmdbKey +"&query=";
+.factory("searchTv", ["$http", function($http) {
+    // server caches searches, same response shape as TMDb
     return {
         get: function(title, page) {
             page = page || 1;
-            return $http.get(
-                searchStr + encodeURI(title) + "&page=" + page)
+            return $http.get("/search/tv", 
+                {params: {q: title, page: page}, cache: true})
                 .then(function success(result) {
                     return result.data;
                 });
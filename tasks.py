@@ -1,42 +1,173 @@
+import logging
+import time
 import webapp2
-from database import database, Series, AppStat
+from datetime import date, datetime, timedelta
+from database import (database, AppStat, LoadResult, RatingBuffer, 
+    TrackedSeries, UserRating)
 from tmdb import TMDB
 from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
 
 class TaskHandler(webapp2.RequestHandler):
+    # TMDb only reports changes for up to 14 days
+    MAX_SYNC_DAYS = 14
+    # sync_high_water value once its date is a complete day
+    SYNCED_WHOLE_DAY = 1
+    # series updated by one update_series_batch task
+    BATCH_SIZE = 20
+    # tasks per Queue.add call
+    MAX_TASKS_PER_ADD = 100
+
     def sync(self):
         """
-        Reloads shows to db that were changed in the last 24 hours
+        Updates tracked shows that TMDb changed since the last sync.
+        The date the last successful sync covered is kept in AppStat.
+        Progress is checkpointed after every page of changes,
+        so a failed sync resumes where it stopped.
+        Syncs up to yesterday, today's list of changes is still growing
+        and its pages would shift between a failed run and its resume.
         """
-        # Get changed ids from tmdb
-        changed_ids = TMDB.tv_changed_ids()
-
-        # track # of changes
-        updated_count = AppStat.get_by_id("daily_sync_count")
+        high_water, progress, updated_count = ndb.get_multi([
+            ndb.Key(AppStat, "sync_high_water"),
+            ndb.Key(AppStat, "sync_progress"),
+            ndb.Key(AppStat, "daily_sync_count")])
+        if not high_water:
+            high_water = AppStat(id="sync_high_water",
+                description="Changes are synced up to this date")
+        if not progress:
+            progress = AppStat(id="sync_progress",
+                description="End date and last page of an unfinished sync")
         if not updated_count:
             updated_count = AppStat(id="daily_sync_count", 
-                description="Number of seasons updated last night")
-        updated_count.value = 0
+                description="Number of series updated last sync")
+
+        today = date.today()
+        yesterday = today - timedelta(1)
+        synced = (high_water.text and 
+            datetime.strptime(high_water.text, "%Y-%m-%d").date())
+        if synced and high_water.value == self.SYNCED_WHOLE_DAY:
+            start_date = synced + timedelta(1)
+        elif synced:
+            # synced up to the day it ran, that day may be incomplete
+            start_date = synced
+        else:
+            start_date = yesterday
+        start_date = max(start_date, 
+            today - timedelta(self.MAX_SYNC_DAYS)).isoformat()
+
+        if not progress.text:
+            # start a new sync, otherwise resume the unfinished one
+            if start_date > yesterday.isoformat():
+                logging.info("Changes are synced up to %s" % high_water.text)
+                return
+            progress.text = yesterday.isoformat()
+            progress.value = 0
+            updated_count.value = 0
+        end_date = progress.text
+
+        # one read, then every page is filtered in memory
+        tracked_ids = set(TrackedSeries.get_ids())
+
+        page = progress.value + 1
+        while True:
+            result = TMDB.tv_changed_ids_page(page, start_date, end_date)
+            if result is None:
+                # let cron retry, progress is kept
+                raise Exception("Sync failed on page %d" % page)
+            changed_ids, total_pages = result
 
-        # if a show in db changed, update
-        new_series_list = list()
-        for changed_id in changed_ids:
-            series = Series.get_by_id(changed_id)
-            if series:
-                # enqueue update series
-                self.add_update_series(changed_id)
-                updated_count.value += 1
+            # if a show in db changed, update in batches
+            changed_ids = sorted(tracked_ids.intersection(changed_ids))
+            self.add_update_series_batches(changed_ids, start_date)
+            updated_count.value += len(changed_ids)
 
-        updated_count.put()
-        return
+            progress.value = page
+            ndb.put_multi([progress, updated_count])
+            if page >= total_pages:
+                break
+            page += 1
+
+        high_water.text = end_date
+        high_water.value = self.SYNCED_WHOLE_DAY
+        progress.text = None
+        progress.value = 0
+        ndb.put_multi([high_water, progress])
+        logging.info("Synced changes from %s to %s, %d series updated" % 
+            (start_date, end_date, updated_count.value))
 
     def load_series(self):
-        series_id = self.request.get('series_id')
-        database.load_series(series_id)
+        series_id = int(self.request.get('series_id'))
+        result = database.load_series(series_id)
+        if result in (LoadResult.FAILED, LoadResult.LOADING):
+            # let the task queue retry
+            raise Exception("Couldn't load series %d" % series_id)
+        if result == LoadResult.LOADED:
+            # users may have rated it before it was stored
+            self.add_refresh_summaries([series_id])
+
+    def update_series_batch(self):
+        series_ids = self.request.get('series_ids').split(',')
+        start_date = self.request.get('start_date') or None
+        self.update_batch([int(i) for i in series_ids], start_date)
 
     def update_series(self):
-        series_id = self.request.get('series_id')
-        database.update_series(series_id)
+        """
+        Runs update_series tasks queued by the sync before it queued batches.
+        Only needed until those have drained.
+        """
+        series_id = int(self.request.get('series_id'))
+        start_date = self.request.get('start_date') or None
+        self.update_batch([series_id], start_date)
+
+    def update_batch(self, series_ids, start_date):
+        updated, failed = database.update_series_batch(series_ids, start_date)
+        if updated:
+            self.add_refresh_summaries(updated)
+        if failed:
+            # let the task queue retry, updates are idempotent
+            raise Exception("Couldn't get changes for series %s" % failed)
+
+    def refresh_summaries(self):
+        series_ids = self.request.get('series_ids').split(',')
+        UserRating.refresh_series_summaries([int(i) for i in series_ids])
+
+    def flush_ratings(self):
+        user_id = self.request.get('user_id')
+        if not RatingBuffer.flush(user_id):
+            # buffer kept changing, let the queue retry
+            self.error(500)
+
+    def migrate_seasons(self):
+        """
+        Moves seasons out of the Series entity, one batch per task
+        """
+        cursor = self.request.get('cursor')
+        cursor = cursor and Cursor(urlsafe=cursor)
+        next_cursor = database.migrate_seasons(cursor)
+        if next_cursor:
+            self.add_migrate_seasons(next_cursor.urlsafe())
+
+    def reconcile_tracked(self):
+        """
+        Indexes stored series that TrackedSeries.add missed,
+        e.g. because it failed after the series was put
+        """
+        TrackedSeries.reconcile()
+
+    def build_search_snapshot(self):
+        from search import LocalIndex
+        LocalIndex.build_snapshot()
+
+    def backfill_summaries(self):
+        """
+        Summarizes series ratings from before summaries, one batch per task
+        """
+        cursor = self.request.get('cursor')
+        cursor = cursor and Cursor(urlsafe=cursor)
+        next_cursor = UserRating.backfill_summaries(cursor)
+        if next_cursor:
+            self.add_backfill_summaries(next_cursor.urlsafe())
 
     @staticmethod
     def add_load_series(series_id):
@@ -45,11 +176,66 @@ class TaskHandler(webapp2.RequestHandler):
             params={'series_id':series_id},
             retry_options=taskqueue.TaskRetryOptions(task_retry_limit=5))    
 
+    @classmethod
+    def add_update_series_batches(cls, series_ids, start_date=None):
+        """
+        Splits series_ids into batches and enqueues one
+        update_series_batch task per batch, with few Queue.add calls.
+        """
+        tasks = list()
+        for i in range(0, len(series_ids), cls.BATCH_SIZE):
+            batch = series_ids[i:i + cls.BATCH_SIZE]
+            tasks.append(taskqueue.Task(url="/tasks/update_series_batch",
+                params={'series_ids':','.join(str(s) for s in batch), 
+                    'start_date':start_date or ''},
+                retry_options=taskqueue.TaskRetryOptions(task_retry_limit=5)))
+
+        queue = taskqueue.Queue("tmdb-queue")
+        for i in range(0, len(tasks), cls.MAX_TASKS_PER_ADD):
+            queue.add(tasks[i:i + cls.MAX_TASKS_PER_ADD])
+
     @staticmethod
-    def add_update_series(series_id):
-        taskqueue.add(url="/tasks/update_series",
-            queue_name="tmdb-queue",
-            params={'series_id':series_id},
+    def add_flush_ratings(user_id):
+        try:
+            taskqueue.add(url="/tasks/flush_ratings",
+                params={'user_id':user_id},
+                countdown=RatingBuffer.FLUSH_DELAY,
+                retry_options=taskqueue.TaskRetryOptions(task_retry_limit=5))
+        except taskqueue.Error:
+            # nothing else would flush the buffer, write through
+            logging.exception("Couldn't enqueue rating flush for %s" % user_id)
+            RatingBuffer.flush(user_id)
+
+    @staticmethod
+    def add_refresh_summaries(series_ids):
+        taskqueue.add(url="/tasks/refresh_summaries",
+            params={'series_ids':','.join(str(i) for i in series_ids)},
+            retry_options=taskqueue.TaskRetryOptions(task_retry_limit=5))
+
+    @staticmethod
+    def add_migrate_seasons(cursor=None):
+        taskqueue.add(url="/tasks/migrate_seasons",
+            params={'cursor':cursor or ''},
+            retry_options=taskqueue.TaskRetryOptions(task_retry_limit=5))
+
+    @staticmethod
+    def add_build_search_snapshot(version):
+        """
+        One task per search version and minute, however many instances ask.
+        The minute is in the name since task names stay taken for days.
+        """
+        try:
+            taskqueue.add(url="/tasks/build_search_snapshot",
+                name='search-snapshot-%d-%d' % (version, time.time() // 60),
+                retry_options=taskqueue.TaskRetryOptions(task_retry_limit=5))
+        except (taskqueue.TaskAlreadyExistsError, 
+            taskqueue.TombstonedTaskError):
+            pass
+
+    @staticmethod
+    def add_backfill_summaries(cursor=None):
+        taskqueue.add(url="/tasks/backfill_summaries",
+            params={'cursor':cursor or ''},
             retry_options=taskqueue.TaskRetryOptions(task_retry_limit=5))
 
 app = webapp2.WSGIApplication([
@@ -57,5 +243,25 @@ app = webapp2.WSGIApplication([
         handler=TaskHandler, handler_method="load_series", methods=['POST']),
     webapp2.Route('/tasks/update_series', 
         handler=TaskHandler, handler_method="update_series", methods=['POST']),
+    webapp2.Route('/tasks/update_series_batch', 
+        handler=TaskHandler, handler_method="update_series_batch", 
+        methods=['POST']),
+    webapp2.Route('/tasks/flush_ratings', 
+        handler=TaskHandler, handler_method="flush_ratings", methods=['POST']),
+    webapp2.Route('/tasks/refresh_summaries', 
+        handler=TaskHandler, handler_method="refresh_summaries", 
+        methods=['POST']),
+    webapp2.Route('/tasks/migrate_seasons', 
+        handler=TaskHandler, handler_method="migrate_seasons"),
+    webapp2.Route('/tasks/backfill_summaries', 
+        handler=TaskHandler, handler_method="backfill_summaries"),
+    webapp2.Route('/tasks/reconcile_tracked', 
+        handler=TaskHandler, handler_method="reconcile_tracked"),
+    webapp2.Route('/tasks/build_search_snapshot', 
+        handler=TaskHandler, handler_method="build_search_snapshot", 
+        methods=['POST']),
     webapp2.Route('/tasks/sync', handler=TaskHandler, handler_method="sync")
-], debug=True)
\ No newline at end of file
+], debug=True)
+
+import appengine_config
+appengine_config.report_startup('tasks')
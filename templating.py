@@ -0,0 +1,114 @@
+"""
+Jinja environment, built on first render instead of at import.
+Deployed instances load templates precompiled into COMPILED_DIR
+by running this module, the dev server reads templates/ directly,
+and so does an instance whose compiled templates don't match them.
+FragmentCache keeps rendered parts of pages in memcache.
+"""
+import hashlib
+import logging
+import os
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+COMPILED_DIR = os.path.join(os.path.dirname(__file__), 'compiled_templates')
+# sources_digest of the templates that were compiled
+COMPILED_DIGEST = os.path.join(COMPILED_DIR, 'sources.sha1')
+
+_env = None
+
+def is_dev_server():
+    return os.environ.get('SERVER_SOFTWARE', '').startswith('Development')
+
+def new_env(loader):
+    import jinja2
+    return jinja2.Environment(loader=loader,
+        autoescape=True,
+        line_statement_prefix='#')
+
+def sources_digest():
+    """sha1 of the names and sources of every template"""
+    digest = hashlib.sha1()
+    for root, dirs, files in sorted(os.walk(TEMPLATE_DIR)):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, TEMPLATE_DIR) + '\0')
+            with open(path, 'rb') as f:
+                digest.update(f.read() + '\0')
+    return digest.hexdigest()
+
+def compiled_is_current():
+    if not os.path.isfile(COMPILED_DIGEST):
+        return False
+    with open(COMPILED_DIGEST) as f:
+        if f.read().strip() == sources_digest():
+            return True
+    logging.warning("Compiled templates are stale, reading templates/")
+    return False
+
+def get_env():
+    global _env
+    if _env is None:
+        import jinja2
+        if not is_dev_server() and compiled_is_current():
+            loader = jinja2.ModuleLoader(COMPILED_DIR)
+        else:
+            loader = jinja2.FileSystemLoader(TEMPLATE_DIR)
+        _env = new_env(loader)
+    return _env
+
+def render_str(template, **params):
+    return get_env().get_template(template).render(params)
+
+class FragmentCache:
+    """
+    Rendered template fragments in memcache, keyed by the versions
+    of what they show, so a version bump is the only invalidation.
+    """
+    PREFIX = 'fragment:'
+    TTL = 24 * 60 * 60 # seconds
+
+    @classmethod
+    def key(cls, *parts):
+        digest = hashlib.sha1(repr(parts)).hexdigest()
+        return cls.PREFIX + digest
+
+    @classmethod
+    def render_multi(cls, template, fragments, before_render=None):
+        """
+        Renders template once for each (key, params) in fragments,
+        reusing cached renders. A key of None skips the cache.
+        before_render gets the params of every fragment that has to
+        be rendered, before any is.
+        Returns a list of Markup, in the order of fragments.
+        """
+        import jinja2
+        from google.appengine.api import memcache
+        keys = [k for k, params in fragments if k is not None]
+        cached = memcache.get_multi(keys) if keys else dict()
+
+        misses = [i for i, (k, params) in enumerate(fragments) 
+            if k is None or k not in cached]
+        if misses and before_render:
+            before_render([fragments[i][1] for i in misses])
+
+        html = [cached.get(k) for k, params in fragments]
+        to_cache = dict()
+        for i in misses:
+            k, params = fragments[i]
+            html[i] = render_str(template, **params)
+            if k is not None:
+                to_cache[k] = html[i]
+        if to_cache:
+            memcache.set_multi(to_cache, time=cls.TTL)
+        return [jinja2.Markup(h) for h in html]
+
+def compile_templates():
+    """Run before deploying, python templating.py, deploy.bat does"""
+    import jinja2
+    env = new_env(jinja2.FileSystemLoader(TEMPLATE_DIR))
+    env.compile_templates(COMPILED_DIR, zip=None, ignore_errors=False)
+    with open(COMPILED_DIGEST, 'w') as f:
+        f.write(sources_digest())
+
+if __name__ == '__main__':
+    compile_templates()
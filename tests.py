@@ -1,5 +1,6 @@
 from main import *
 from database import *
+from tmdb import ResponseCache
 
 class TestHandler(BaseHandler):
     def get(self, *a):
@@ -20,6 +21,14 @@ class TestHandler(BaseHandler):
     def sync(self, *a):
         database.sync_with_tmdb()
 
+    def cache_stats(self, *a):
+        self.render_json(ResponseCache.stats())
+
+    def startup(self, *a):
+        import appengine_config
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.write(appengine_config.import_timer.report(limit=100))
+
     def images(self, *a):
         q = self.request.get('q')
         if not q:
@@ -49,15 +58,39 @@ class TestHandler(BaseHandler):
                 url = TmdbConfig.poster_path(i) + season.poster()
                 url_list.append((desc, url))
 
-        episode = season.get_episode(1)
-        if episode.still():
+        episode = series.episode_details(1, 1)
+        if episode and episode.get('still_path'):
             for i in range(4):
-                desc = "Episode %s poster. size %d" % (episode.name(), i)
-                url = TmdbConfig.poster_path(i) + episode.still()
+                desc = "Episode %s poster. size %d" % (episode.get('name'), i)
+                url = TmdbConfig.poster_path(i) + episode.get('still_path')
                 url_list.append((desc, url))
 
         self.render('images-example.html', url_list=url_list)
 
+    def season_zero(self, *a):
+        """
+        Regression check: TMDb changes to Specials (season 0) are stored.
+        Uses a throwaway series that is deleted afterwards.
+        """
+        series_id = 2**62
+        series = Series(id=series_id, json={'id':series_id, 'name':'check'})
+        changes = [{'key':'season', 'items':[
+            {'action':'added', 'value':{'season_number':0}}]}]
+        _, refetch_seasons, deleted_seasons = database.plan_update(changes)
+        seasons_json = {n:{'id':n, 'season_number':n, 'name':'Specials'} 
+            for n in refetch_seasons}
+        database.apply_update(series, None, seasons_json, deleted_seasons)
+        try:
+            series.put_all()
+            stored = Series.get_by_id(series_id, use_cache=False)
+            stored.load_seasons()
+            season = stored.get_season(0)
+            self.render_json({'stored': season is not None and 
+                season.number() == 0})
+        finally:
+            ndb.delete_multi(
+                ndb.Query(ancestor=series.key).fetch(keys_only=True))
+
     def populate(self, *a):
         pass
 
@@ -70,5 +103,8 @@ app = webapp2.WSGIApplication([
     webapp2.Route('/test/populate<:/?>', handler=TestHandler, handler_method="populate"),
     webapp2.Route('/test/changes<:/?>', handler=TestHandler,handler_method="changes"),
     webapp2.Route('/test/sync<:/?>', handler=TestHandler, handler_method="sync"),
-    webapp2.Route('/test/copy<:/?>', handler=TestHandler, handler_method="copy")
+    webapp2.Route('/test/season_zero<:/?>', handler=TestHandler, handler_method="season_zero"),
+    webapp2.Route('/test/copy<:/?>', handler=TestHandler, handler_method="copy"),
+    webapp2.Route('/test/cache_stats<:/?>', handler=TestHandler, handler_method="cache_stats"),
+    webapp2.Route('/test/startup<:/?>', handler=TestHandler, handler_method="startup")
 ], debug=True)
\ No newline at end of file
@@ -1,7 +1,11 @@
 import os
 import json
 import cgi
+import collections
+import hashlib
 import logging
+import random
+import threading
 import time
 from datetime import datetime, timedelta
 
@@ -9,7 +13,7 @@ from urllib import urlencode
 from google.appengine.api import urlfetch
 from google.appengine.api import memcache
 
-from utilities import load_secret
+from utilities import load_secret, LRUCache
 
 BASE_URL = 'http://api.themoviedb.org/3'
 API_KEY = load_secret('tmdb-key.txt')
@@ -22,58 +26,386 @@ def cgi_space_escape(text):
     """cgi escape w/ additional escape for spaces"""
     return cgi.escape(text, quote=True).replace(' ', '%20')
 
+# TMDb allows 40 requests every 10 seconds per IP
+RATE_LIMIT = 40
+RATE_PERIOD = 10 # seconds
+MAX_IN_FLIGHT = 10 # concurrent urlfetch rpcs in fetch_json_multi
+FETCH_DEADLINE = 10 # seconds
+# longest user facing requests wait for a token, they serve stale data instead
+INTERACTIVE_WAIT = 2 # seconds
+
+# retries of 429 and 5xx responses
+MAX_RETRIES = 4
+BACKOFF_BASE = 1 # seconds, doubled on every retry
+
+# how long responses are served from cache without asking TMDb, in seconds
+SEARCH_TTL = 60 * 60
+SERIES_TTL = 12 * 60 * 60 # nightly sync refreshes changed series
+CONFIGURATION_TTL = 24 * 60 * 60
+
+CachedResponse = collections.namedtuple('CachedResponse', 'fetched etag content')
+
+class ResponseCache:
+    """
+    Two tier cache of TMDb responses,
+    an in-process LRU in front of memcache.
+    Entries outlive their ttl so that stale ones can be
+    revalidated with their etag instead of refetched.
+    Raw content is cached, so every caller parses its own copy.
+    Responses too big for memcache are only kept locally.
+    """
+    PREFIX = 'tmdb-response:'
+    STATS_PREFIX = 'tmdb-cache-stats:'
+    MEMCACHE_TIME = 7 * 24 * 60 * 60 # seconds
+    # leaves room for the key, etag and pickling
+    MEMCACHE_MAX_CONTENT = memcache.MAX_VALUE_SIZE - 10000 # bytes
+    LOCAL_MAX_SIZE = 8 * 1024 * 1024 # bytes of content in instance memory
+    STATS_FLUSH_INTERVAL = 10 # seconds between writes of the shared counters
+    local = LRUCache(200, max_size=LOCAL_MAX_SIZE, 
+        sizeof=lambda entry: len(entry.content))
+    local_stats = collections.Counter()
+    unflushed_stats = collections.Counter()
+    stats_flushed = time.time()
+    stats_lock = threading.Lock()
+
+    @classmethod
+    def key(cls, url):
+        # urls can be longer than memcache keys
+        return cls.PREFIX + hashlib.sha1(url).hexdigest()
+
+    @classmethod
+    def get(cls, url):
+        key = cls.key(url)
+        entry = cls.local.get(key)
+        if entry is None:
+            entry = memcache.get(key)
+            if entry is not None:
+                cls.local.set(key, entry)
+        return entry
+
+    @classmethod
+    def set(cls, url, entry):
+        key = cls.key(url)
+        cls.local.set(key, entry)
+        if len(entry.content) > cls.MEMCACHE_MAX_CONTENT:
+            return
+        try:
+            memcache.set(key, entry, time=cls.MEMCACHE_TIME)
+        except ValueError as e:
+            logging.warning("Not caching TMDb response for %s: %s" % (url, e))
+
+    @classmethod
+    def count(cls, name):
+        """
+        Counts locally, the shared counters are written
+        at most every STATS_FLUSH_INTERVAL in one batch.
+        """
+        with cls.stats_lock:
+            cls.local_stats[name] += 1
+            cls.unflushed_stats[name] += 1
+            if time.time() - cls.stats_flushed < cls.STATS_FLUSH_INTERVAL:
+                return
+        cls.flush_stats()
+
+    @classmethod
+    def flush_stats(cls):
+        with cls.stats_lock:
+            offsets = dict(cls.unflushed_stats)
+            cls.unflushed_stats.clear()
+            cls.stats_flushed = time.time()
+        if offsets:
+            memcache.offset_multi(offsets, key_prefix=cls.STATS_PREFIX, 
+                initial_value=0)
+
+    @classmethod
+    def stats(cls):
+        """Counters across all instances, and for this instance"""
+        cls.flush_stats()
+        names = ('hit', 'miss', 'revalidated')
+        shared = memcache.get_multi(names, key_prefix=cls.STATS_PREFIX)
+        return {'all':shared, 'instance':dict(cls.local_stats)}
+
+class RateLimiter:
+    """
+    Token bucket shared by every instance through memcache.
+    Holds up to RATE_LIMIT tokens, refilled at RATE_LIMIT per RATE_PERIOD.
+    Tokens can go negative, each request reserves its slot and
+    waits until the bucket would have refilled it.
+    The debt is capped at MAX_DEBT, so a burst can't make
+    everyone behind it sleep for minutes.
+    """
+    KEY = 'tmdb-token-bucket'
+    RETRIES = 10
+    MAX_DEBT = RATE_LIMIT # tokens, at most RATE_PERIOD of waiting
+    DEBT_POLL = 1 # seconds background callers wait while the debt is capped
+
+    @classmethod
+    def take(cls, max_wait=None):
+        """
+        Takes a token, returns how many seconds to wait before using it.
+        Returns None and takes nothing if the wait would be longer
+        than max_wait, or the bucket is at MAX_DEBT.
+        """
+        client = memcache.Client()
+        rate = float(RATE_LIMIT) / RATE_PERIOD
+        for _ in range(cls.RETRIES):
+            now = time.time()
+            state = client.gets(cls.KEY)
+            if state is None:
+                if client.add(cls.KEY, (RATE_LIMIT - 1, now)):
+                    return 0
+                continue
+
+            tokens, updated = state
+            tokens = min(RATE_LIMIT, tokens + (now - updated) * rate) - 1
+            wait = max(0, -tokens / rate)
+            if tokens < -cls.MAX_DEBT or (
+                max_wait is not None and wait > max_wait):
+                return None
+            if client.cas(cls.KEY, (tokens, now)):
+                return wait
+
+        # memcache is contended or down, pace this request alone
+        logging.warning("TMDb token bucket unavailable")
+        return 1 / rate
+
+    @classmethod
+    def give_back(cls):
+        """Returns a token that was taken but not used"""
+        client = memcache.Client()
+        for _ in range(cls.RETRIES):
+            state = client.gets(cls.KEY)
+            if state is None:
+                return
+            tokens, updated = state
+            if client.cas(cls.KEY, (min(RATE_LIMIT, tokens + 1), updated)):
+                return
+
+    @classmethod
+    def acquire(cls, max_wait=None):
+        """
+        Waits for a token. Without max_wait this waits as long as it takes,
+        otherwise returns False at once if it would be longer.
+        """
+        while True:
+            wait = cls.take(max_wait)
+            if wait is not None:
+                break
+            if max_wait is not None:
+                return False
+            time.sleep(random.uniform(cls.DEBT_POLL, 2 * cls.DEBT_POLL))
+
+        if wait > 0:
+            try:
+                time.sleep(wait)
+            except:
+                # e.g. the request deadline, the slot goes unused
+                cls.give_back()
+                raise
+        return True
+
 class TMDB:
     @classmethod
-    def fetch_json(cls, url):
+    def fetch_json(cls, url, ttl=None, fresh=False, max_wait=None):
         """
         Contacts the TMDb server. 
         Handles rate-limiting conditions
+        Responses are cached for ttl seconds if it's given.
+        fresh revalidates a cached response even if it isn't stale.
+        max_wait bounds the seconds spent waiting on the rate limit.
         """
-        r = urlfetch.fetch(url=url, headers={'Accept':'application/json'})
+        entry, usable = cls.cache_lookup(url, ttl, fresh)
+        if usable:
+            return json.loads(entry.content)
+
+        if not RateLimiter.acquire(max_wait):
+            return cls.stale(url, entry)
+        r = urlfetch.fetch(url=url, headers=cls.request_headers(entry), 
+            deadline=FETCH_DEADLINE)
         logging.info("urlfetch: %s" % url)
+        return cls.finish_response(url, r, ttl, entry, max_wait)
+
+    @classmethod
+    def stale(cls, url, entry):
+        """Json of the cached entry (or None) when there's no token in time"""
+        logging.warning("No TMDb token in time for %s" % url)
+        return entry and json.loads(entry.content)
+
+    @classmethod
+    def cache_lookup(cls, url, ttl, fresh):
+        """
+        Returns the cached entry for url, and whether
+        it can be used without contacting TMDb.
+        """
+        if not ttl:
+            return None, False
+
+        entry = ResponseCache.get(url)
+        usable = (entry is not None and not fresh and 
+            time.time() - entry.fetched < ttl)
+        ResponseCache.count('hit' if usable else 'miss')
+        return entry, usable
+
+    @classmethod
+    def request_headers(cls, entry):
+        if entry is None or not entry.etag:
+            return headers
+        conditional = dict(headers)
+        conditional['If-None-Match'] = entry.etag
+        return conditional
 
-        # too many requests from this ip. cool off.
-        if r.status_code == 429:
-            retry_after = int(r.headers.get('retry-after'))
-            logging.warning(
-                "TMDB status_code 429, sleeping %d seconds" % (retry_after+1))
-            time.sleep(retry_after + 1)
-            r = urlfetch.fetch(url=url, headers={'Accept':'application/json'})
+    @classmethod
+    def finish_response(cls, url, r, ttl, entry, max_wait=None):
+        """
+        Returns json for a urlfetch response, using the cached entry
+        if TMDb says it's still good. Caches new responses.
+        """
+        # retries revalidate the same way as the first request
+        r = cls.check_response(url, r, cls.request_headers(entry), max_wait)
+        if r is None:
+            return None
+        if r.status_code == 304 and entry is not None:
+            ResponseCache.count('revalidated')
+            ResponseCache.set(url, entry._replace(fetched=time.time()))
+            return json.loads(entry.content)
+
+        if ttl:
+            ResponseCache.set(url, 
+                CachedResponse(time.time(), r.headers.get('etag'), r.content))
+        return json.loads(r.content)
+
+    @classmethod
+    def check_response(cls, url, r, request_headers=headers, max_wait=None):
+        """
+        Refetches with jittered exponential backoff while TMDb
+        says we're going too fast or has a server error.
+        Gives up on waits longer than max_wait.
+        Returns the successful (or not modified) response or None.
+        """
+        for attempt in range(MAX_RETRIES):
+            if r.status_code != 429 and r.status_code < 500:
+                break
 
-        if r.status_code != 200:
+            delay = BACKOFF_BASE * 2 ** attempt
+            delay = random.uniform(delay / 2.0, delay)
+            # too many requests from this ip. cool off.
+            retry_after = r.headers.get('retry-after')
+            if r.status_code == 429 and retry_after:
+                delay = max(delay, int(retry_after))
+            if max_wait is not None and delay > max_wait:
+                break
+            logging.warning("TMDB status_code %d, sleeping %.1f seconds" % 
+                (r.status_code, delay))
+            time.sleep(delay)
+
+            if not RateLimiter.acquire(max_wait):
+                break
+            r = urlfetch.fetch(url=url, headers=request_headers,
+                deadline=FETCH_DEADLINE)
+
+        if r.status_code not in (200, 304):
             logging.error(
                 "urlfetch error 200 in TMDd: %s \nHeaders: %s, \nContent: %s" % 
                 (url, str(r.headers), r.content))
             return None
-        data = json.loads(r.content)
-        return data
-    
+        return r
+
     @classmethod
-    def search_tv_str(cls, title):
+    def fetch_json_multi(cls, urls, ttl=None, fresh=False, max_wait=None):
+        """
+        Contacts the TMDb server for several urls at once.
+        At most MAX_IN_FLIGHT rpcs are outstanding at any time,
+        and each waits for a token from RateLimiter.
+        Cached responses and max_wait are used like in fetch_json.
+        Returns a list of json (or None) in the same order as urls.
+        """
+        results = [None] * len(urls)
+        pending = list()
+        for i, url in enumerate(urls):
+            entry, usable = cls.cache_lookup(url, ttl, fresh)
+            if usable:
+                results[i] = json.loads(entry.content)
+            else:
+                pending.append((i, url, entry))
+        in_flight = list()
+
+        while pending or in_flight:
+            while pending and len(in_flight) < MAX_IN_FLIGHT:
+                # rpcs already in flight keep going while this waits
+                i, url, entry = pending.pop(0)
+                if not RateLimiter.acquire(max_wait):
+                    results[i] = cls.stale(url, entry)
+                    continue
+                rpc = urlfetch.create_rpc(deadline=FETCH_DEADLINE)
+                urlfetch.make_fetch_call(rpc, url, 
+                    headers=cls.request_headers(entry))
+                logging.info("urlfetch async: %s" % url)
+                in_flight.append((i, url, entry, rpc))
+            if not in_flight:
+                continue
+
+            i, url, entry, rpc = in_flight.pop(0)
+            try:
+                r = rpc.get_result()
+            except urlfetch.Error as e:
+                logging.error("urlfetch failed in TMDb: %s \n%s" % (url, e))
+                continue
+            results[i] = cls.finish_response(url, r, ttl, entry, max_wait)
+
+        return results
+
+    @classmethod
+    def search_tv_str(cls, title, page=1):
         title = cgi_space_escape(title)
-        url = BASE_URL + "/search/tv?api_key={key}&query={title}" 
-        url = url.format(title=title, key=API_KEY)
+        url = BASE_URL + "/search/tv?api_key={key}&query={title}&page={page}" 
+        url = url.format(title=title, key=API_KEY, page=page)
         return url
 
     @classmethod
     def search_tv(cls, title):
-        url = cls.search_tv_str(title)
-        resp_json = cls.fetch_json(url)
-        return resp_json.get('results')
+        resp_json = cls.search_tv_page(title)
+        return resp_json and resp_json.get('results')
 
     @classmethod
-    def series(cls, series_id):
+    def search_tv_page(cls, title, page=1, max_wait=None):
+        """Full response for a page of results, including total_pages"""
+        url = cls.search_tv_str(title, page)
+        return cls.fetch_json(url, ttl=SEARCH_TTL, max_wait=max_wait)
+
+    @classmethod
+    def series_str(cls, series_id):
         url = (BASE_URL + 
             '/tv/{series_id}?api_key={key}'
             '&append_to_response=external_ids')
         url = url.format(series_id=str(series_id), key=API_KEY)
-        return cls.fetch_json(url)
+        return url
+
+    @classmethod
+    def series(cls, series_id, fresh=False, max_wait=None):
+        return cls.fetch_json(cls.series_str(series_id), 
+            ttl=SERIES_TTL, fresh=fresh, max_wait=max_wait)
 
     @classmethod
-    def season(cls, series_id, season_number):
+    def season_str(cls, series_id, season_number):
         url = BASE_URL + '/tv/{series_id}/season/{num}?api_key={key}'
         url = url.format(series_id=str(series_id), num=str(season_number), key=API_KEY)
-        return cls.fetch_json(url)
+        return url
+
+    @classmethod
+    def season(cls, series_id, season_number, fresh=False):
+        return cls.fetch_json(cls.season_str(series_id, season_number),
+            ttl=SERIES_TTL, fresh=fresh)
+
+    @classmethod
+    def seasons(cls, series_id, season_numbers, fresh=False, max_wait=None):
+        """
+        Fetches several seasons of a series concurrently.
+        Returns a dict mapping season number to json (or None)
+        """
+        urls = [cls.season_str(series_id, num) for num in season_numbers]
+        return dict(zip(season_numbers, 
+            cls.fetch_json_multi(urls, ttl=SERIES_TTL, fresh=fresh, 
+                max_wait=max_wait)))
 
     @classmethod
     def episode(cls, series_id, season_number, episode_number):
@@ -82,54 +414,77 @@ class TMDB:
             '/episode/{episode_number}?api_key={key}')
         url = url.format(series_id=str(series_id), season_number=str(season_number), 
             episode_number=str(episode_number), key=API_KEY)
-        return cls.fetch_json(url)
+        return cls.fetch_json(url, ttl=SERIES_TTL)
 
     @classmethod
     def configuration(cls):
         url = (BASE_URL + "/configuration?api_key={key}")
         url = url.format(key=API_KEY)
-        return cls.fetch_json(url)
+        return cls.fetch_json(url, ttl=CONFIGURATION_TTL)
 
     @classmethod
-    def tv_changes(cls, page, start_date=None):
+    def tv_changes(cls, page, start_date=None, end_date=None):
         url = (BASE_URL + '/tv/changes?api_key={key}&page={page}')
-        if start_date is None:
-            url = url.format(key=API_KEY, page=str(page))
-        else:
+        if start_date is not None:
             url = url + '&start_date={start_date}'
-            url = url.format(key=API_KEY, page=str(page), start_date=start_date)
+        if end_date is not None:
+            url = url + '&end_date={end_date}'
+        url = url.format(key=API_KEY, page=str(page), 
+            start_date=start_date, end_date=end_date)
         return cls.fetch_json(url)
 
     @classmethod
-    def tv_changed_ids(cls, start_date=None):
+    def tv_changed_ids_page(cls, page, start_date=None, end_date=None):
+        """
+        Gives the ids of series on one page of changes, and the
+        total number of pages. None if TMDb couldn't be reached.
+        """
+        data = cls.tv_changes(page, start_date, end_date)
+        if data is None:
+            return None
+        ids = [int(item.get('id')) for item in data.get('results')]
+        return ids, data.get('total_pages')
+
+    @classmethod
+    def tv_changed_ids(cls, start_date=None, end_date=None):
         """
         Gives a list containing the ids of series that have changed
-        in the last 24hrs
+        since start_date, in the last 24hrs by default
         """
-        # TODO implement start_date
-        data = cls.tv_changes(page=1, start_date=start_date)
-        results = data.get('results')
-        total_pages = data.get('total_pages')
+        ids, total_pages = cls.tv_changed_ids_page(1, start_date, end_date)
         for page in range(2, total_pages+1):
-            results.extend(cls.tv_changes(page, start_date).get('results'))
-
-        ids = [int(item.get('id')) for item in results]
+            ids.extend(cls.tv_changed_ids_page(page, start_date, end_date)[0])
         return ids
 
     @classmethod
-    def series_changes(cls, series_id, start_date=None):
-        """
-        Returns a list of changes with keys "key" and "item"
-        By default, gives last 24 hours
-        """
+    def series_changes_str(cls, series_id, start_date=None):
         url = (BASE_URL + "/tv/{id}/changes?api_key={key}")
         if start_date is None:
             url = url.format(id=series_id, key=API_KEY)
         else:
             url = url + "&start_date={start_date}"
             url = url.format(id=series_id, start_date=start_date, key=API_KEY)
+        return url
 
-        return cls.fetch_json(url).get('changes')
+    @classmethod
+    def series_changes(cls, series_id, start_date=None):
+        """
+        Returns a list of changes with keys "key" and "item"
+        By default, gives last 24 hours
+        """
+        data = cls.fetch_json(cls.series_changes_str(series_id, start_date))
+        return data and data.get('changes')
+
+    @classmethod
+    def series_changes_multi(cls, series_ids, start_date=None):
+        """
+        Fetches the changes of several series concurrently.
+        Returns a dict mapping series id to its list of changes (or None)
+        """
+        urls = [cls.series_changes_str(i, start_date) for i in series_ids]
+        results = cls.fetch_json_multi(urls)
+        return {i:(data and data.get('changes')) 
+            for i, data in zip(series_ids, results)}
 
     @classmethod
     def seasons_changed_in_series(cls, series_id, start_date=None):
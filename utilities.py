@@ -1,5 +1,11 @@
+import __builtin__
+import collections
 import hmac
 import os
+import sys
+import threading
+import time
+import zlib
 
 def enum(*sequential, **named):
     enums = dict(zip(sequential, range(len(sequential))), **named)
@@ -24,4 +30,107 @@ def make_secure_val(val):
 def check_secure_val(secure_val):
     val = secure_val.split('|')[0]
     if secure_val == make_secure_val(val):
-        return val
\ No newline at end of file
+        return val
+
+def gzip_compress(data, level=6):
+    """Compresses a str into the gzip format"""
+    # wbits over 16 writes a gzip header and trailer
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def gzip_decompress(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+class LRUCache(object):
+    """
+    Thread safe least-recently-used cache,
+    for data kept in instance memory between requests.
+    Holds at most capacity items, and if max_size is given,
+    at most max_size in total as measured by sizeof.
+    """
+    def __init__(self, capacity, max_size=None, sizeof=len):
+        self.capacity = capacity
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            item = self.items.pop(key)
+            self.items[key] = item
+            return item[0]
+
+    def set(self, key, value):
+        size = self.sizeof(value) if self.max_size is not None else 0
+        with self.lock:
+            self._pop(key)
+            if self.max_size is not None and size > self.max_size:
+                return
+            self.items[key] = (value, size)
+            self.size += size
+            while (len(self.items) > self.capacity or 
+                self.max_size is not None and self.size > self.max_size):
+                _, (_, evicted) = self.items.popitem(last=False)
+                self.size -= evicted
+
+    def delete(self, key):
+        with self.lock:
+            self._pop(key)
+
+    def _pop(self, key):
+        """Removes key if present, call with the lock held"""
+        if key in self.items:
+            _, size = self.items.pop(key)
+            self.size -= size
+
+class ImportTimer(object):
+    """
+    Records how long each module takes to import, not counting
+    the modules it imports in turn. install() wraps __import__,
+    so the earlier it runs, the more of startup it sees.
+    """
+    def __init__(self):
+        self.times = dict() # module name to seconds
+        self.local = threading.local()
+        self.original = None
+
+    def install(self):
+        self.original = __builtin__.__import__
+        __builtin__.__import__ = self._import
+
+    def uninstall(self):
+        """Restores __import__, later imports aren't timed"""
+        if self.original is not None:
+            __builtin__.__import__ = self.original
+            self.original = None
+
+    def installed(self):
+        return self.original is not None
+
+    def _import(self, name, *args, **kwargs):
+        if name in sys.modules:
+            return self.original(name, *args, **kwargs)
+
+        # time spent in nested imports, for each import in progress
+        nested = self.local.__dict__.setdefault('nested', [])
+        nested.append(0.0)
+        start = time.time()
+        try:
+            return self.original(name, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            own = elapsed - nested.pop()
+            self.times[name] = self.times.get(name, 0.0) + own
+            if nested:
+                nested[-1] += elapsed
+
+    def report(self, limit=30):
+        """The slowest imports, one per line"""
+        slowest = sorted(self.times.items(), key=lambda t: -t[1])[:limit]
+        lines = ["%8.1fms %s" % (t * 1000, name) for name, t in slowest]
+        lines.append("%8.1fms total" % (sum(self.times.values()) * 1000))
+        return "\n".join(lines)